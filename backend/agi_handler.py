@@ -5,35 +5,123 @@ FastAGI Server для real-time обработки звонков с OpenAI/Elev
 import os
 import socket
 import asyncio
-import json
-from pathlib import Path
+import uvloop
+import re
+import time
+import struct
+import hashlib
 import soundfile as sf
 import numpy as np
 import httpx
-from openai import OpenAI
-
-# Manual .env loading
-try:
-    env_path = Path(__file__).parent.parent / '.env'
-    with open(env_path, 'r') as f:
-        for line in f:
-            line = line.strip()
-            if line and not line.startswith('#') and '=' in line:
-                key, value = line.split('=', 1)
-                os.environ[key] = value
-    print("[INIT] Loaded .env manually")
-except Exception as e:
-    print(f"[WARN] Could not load .env: {e}")
+import orjson
+from openai import AsyncOpenAI
+from asyncinotify import Inotify, Mask
+from cachetools import TTLCache
+from env import load_env
+
+load_env()
 
 # Configuration
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 ELEVENLABS_API_KEY = os.getenv('ELEVENLABS_API_KEY')
 ELEVENLABS_VOICE_ID = os.getenv('ELEVENLABS_VOICE_ID', '21m00Tcm4TlvDq8ikWAM')
+DEEPGRAM_API_KEY = os.getenv('DEEPGRAM_API_KEY')
+# Prerecorded API: запись уже готова, поэтому один запрос вместо стрима по websocket
+DEEPGRAM_URL = "https://api.deepgram.com/v1/listen"
+DEEPGRAM_PARAMS = {"model": "nova-2", "language": "ru"}
+# Self-hosted batched Whisper (faster-whisper BatchedInferencePipeline), опционально
+STT_BATCH_URL = os.getenv('STT_BATCH_URL')
+STT_BATCH_MAX_SIZE = int(os.getenv('STT_BATCH_MAX_SIZE', '8'))
+STT_BATCH_WINDOW = float(os.getenv('STT_BATCH_WINDOW', '0.03'))
 
 print(f"[INIT] OpenAI key: {OPENAI_API_KEY[:20] if OPENAI_API_KEY else 'NOT SET'}...")
 print(f"[INIT] ElevenLabs key: {ELEVENLABS_API_KEY[:20] if ELEVENLABS_API_KEY else 'NOT SET'}...")
+print(f"[INIT] Deepgram STT: {'enabled' if DEEPGRAM_API_KEY else 'disabled (Whisper)'}")
+print(f"[INIT] Batched STT: {STT_BATCH_URL or 'disabled'}")
+
+# Асинхронный клиент OpenAI: Whisper/GPT не блокируют event loop остальных звонков
+openai_client = AsyncOpenAI(
+    api_key=OPENAI_API_KEY,
+    http_client=httpx.AsyncClient(
+        http2=True,
+        timeout=60.0,
+        limits=httpx.Limits(max_keepalive_connections=64, max_connections=128)
+    )
+) if OPENAI_API_KEY else None
+
+# Ограничение одновременных запросов к OpenAI, чтобы пик звонков не упирался в rate limit
+OPENAI_MAX_CONCURRENCY = int(os.getenv('OPENAI_MAX_CONCURRENCY', '16'))
+openai_semaphore = asyncio.Semaphore(OPENAI_MAX_CONCURRENCY)
+
+# Формат, который нужен Asterisk: PCM16, 8000 Hz, mono
+TTS_OUTPUT_FORMAT = "pcm_8000"
+TTS_SAMPLE_RATE = 8000
+
+# Ключевые слова для быстрого определения отдела без обращения к GPT.
+# Это основы слов: совпадение ищется только с начала слова, поэтому
+# "подключ" ловит "подключения", а "счёт" не ловит "насчёт"
+DEPARTMENT_KEYWORDS = {
+    'sales': ['купить', 'купл', 'цена', 'цены', 'стоимост', 'сколько стоит', 'заказ', 'тариф', 'подключ'],
+    'support': ['не работа', 'ошибк', 'сломал', 'проблем', 'настроит', 'настройк', 'не могу'],
+    'billing': ['счёт', 'счет', 'оплат', 'деньг', 'денег', 'возврат', 'баланс', 'списал', 'списан'],
+}
+
+# Все ключевые слова в одном регулярном выражении: один проход по тексту,
+# отдел определяется по имени сработавшей группы
+DEPARTMENT_PATTERN = re.compile(
+    r'\b(?:' + '|'.join(
+        f"(?P<{department}>{'|'.join(map(re.escape, keywords))})"
+        for department, keywords in DEPARTMENT_KEYWORDS.items()
+    ) + ')',
+    re.IGNORECASE
+)
+
+# Классификация звонка через GPT
+ROUTING_MODEL = "gpt-4o-mini"
+ROUTING_PROMPT = "Ты — AI ассистент call-центра. Определи, в какой отдел нужно перевести звонок: sales (продажи), support (техподдержка), billing (бухгалтерия). Ответь только названием отдела."
+
+# LRU кэш ответов GPT: одинаковые фразы разных звонящих не требуют повторного запроса
+# (TTL, чтобы смена промпта/отделов подхватывалась без рестарта)
+ROUTING_CACHE_SIZE = int(os.getenv('ROUTING_CACHE_SIZE', '1024'))
+ROUTING_CACHE_TTL = int(os.getenv('ROUTING_CACHE_TTL', '300'))
+routing_cache = TTLCache(maxsize=ROUTING_CACHE_SIZE, ttl=ROUTING_CACHE_TTL)
+
+# Записи звонков от Asterisk
+RECORDINGS_DIR = '/recordings'
+RECORDING_NAME_RE = re.compile(r'^call_(.+)\.wav$')
+RECORDING_WAIT_TIMEOUT = 10.0
+RECORDING_WATCH_RETRY = 5.0  # пауза перед перезапуском упавшего inotify watcher
+# call_id -> Event, выставляется когда Asterisk закрыл файл записи
+# (TTL: события записей, которые никто не ждал, не копятся)
+recording_events = TTLCache(maxsize=10_000, ttl=1800)
+
+# Фразы, которые синтезируются один раз при старте сервера
+PROMPT_TEXTS = {
+    'stall': "Секундочку...",
+    **{
+        f"transfer_{department}": f"Переводю вас в отдел {department}"
+        for department in DEPARTMENT_KEYWORDS
+    },
+}
+# Готовые промпты: имя -> путь для Playback в Asterisk (без расширения)
+prompt_cache = {}
 
-openai_client = OpenAI(api_key=OPENAI_API_KEY) if OPENAI_API_KEY else None
+# Общий HTTP клиент для ElevenLabs TTS (переиспользуем TLS соединения между звонками)
+TTS_CLIENT = httpx.AsyncClient(
+    http2=True,
+    timeout=30.0,
+    limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+    headers={
+        "Accept": "audio/pcm",
+        "xi-api-key": ELEVENLABS_API_KEY or ""
+    }
+)
+
+# HTTP клиент Deepgram STT (только если задан ключ)
+DEEPGRAM_CLIENT = httpx.AsyncClient(
+    timeout=30.0,
+    headers={"Authorization": f"Token {DEEPGRAM_API_KEY}"}
+) if DEEPGRAM_API_KEY else None
 
 
 class AGISession:
@@ -47,13 +135,11 @@ class AGISession:
     async def read_agi_env(self):
         """Read AGI environment variables"""
         print("[AGI] Reading environment...")
-        while True:
-            line = await self.reader.readline()
-            line = line.decode('utf-8').strip()
-            if not line:
-                break
-            if ':' in line:
-                key, value = line.split(':', 1)
+        # Окружение заканчивается пустой строкой - читаем блок целиком за один раз
+        blob = await self.reader.readuntil(b"\n\n")
+        for line in blob.decode('utf-8').splitlines():
+            key, sep, value = line.partition(':')
+            if sep:
                 self.agi_vars[key.strip()] = value.strip()
         print(f"[AGI] Environment loaded: {len(self.agi_vars)} vars")
         
@@ -85,9 +171,98 @@ class AGISession:
         return await self.send_command(f'EXEC Playback {file_path}')
 
 
+async def deepgram_speech_to_text(audio_path: str) -> str:
+    """
+    Распознавание готовой записи через Deepgram (prerecorded API)
+    Формат берётся из WAV заголовка, файл уходит одним запросом
+    """
+    with open(audio_path, 'rb') as audio_file:
+        audio = audio_file.read()
+    response = await DEEPGRAM_CLIENT.post(
+        DEEPGRAM_URL,
+        params=DEEPGRAM_PARAMS,
+        content=audio,
+        headers={"Content-Type": "audio/wav"}
+    )
+    response.raise_for_status()
+    channels = orjson.loads(response.content).get('results', {}).get('channels') or [{}]
+    alternatives = channels[0].get('alternatives') or [{}]
+    return alternatives[0].get('transcript', '')
+
+
+class STTBatcher:
+    """
+    Микро-батчинг STT запросов от параллельных звонков
+    Записи копятся до STT_BATCH_WINDOW секунд (не больше STT_BATCH_MAX_SIZE)
+    и уходят одним multipart запросом: files=[...] -> {"texts": [...]}
+    """
+    
+    def __init__(self, url: str, max_batch: int = STT_BATCH_MAX_SIZE, window: float = STT_BATCH_WINDOW):
+        self.url = url
+        self.max_batch = max_batch
+        self.window = window
+        self.queue = asyncio.Queue()
+        self.client = httpx.AsyncClient(timeout=30.0)
+        self.tasks = set()  # ссылки на запросы батчей, чтобы их не собрал GC
+        
+    async def submit(self, audio_path: str) -> asyncio.Future:
+        """Поставить запись в очередь, результат придёт в future"""
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((audio_path, future))
+        return future
+        
+    async def run(self):
+        """Цикл сборки батчей"""
+        while True:
+            batch = [await self.queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout=timeout))
+                except asyncio.TimeoutError:
+                    break
+            task = asyncio.create_task(self.transcribe_batch(batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+            
+    async def transcribe_batch(self, batch):
+        """Один запрос на весь батч, раздаём результаты по future"""
+        try:
+            files = []
+            for audio_path, _ in batch:
+                with open(audio_path, 'rb') as audio_file:
+                    files.append(('files', (os.path.basename(audio_path), audio_file.read(), 'audio/wav')))
+            
+            response = await self.client.post(self.url, files=files, data={"language": "ru"})
+            response.raise_for_status()
+            texts = response.json()["texts"]
+            if len(texts) != len(batch):
+                # zip молча обрезал бы лишние записи, и их звонки ждали бы вечно
+                raise ValueError(f"STT returned {len(texts)} texts for {len(batch)} files")
+            print(f"[STT] Batch of {len(batch)} transcribed")
+            
+            for (_, future), text in zip(batch, texts):
+                if not future.done():
+                    future.set_result(text)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+                    
+    async def close(self):
+        """Закрытие HTTP клиента"""
+        await self.client.aclose()
+
+
+stt_batcher = STTBatcher(STT_BATCH_URL) if STT_BATCH_URL else None
+
+
 async def speech_to_text(audio_path: str) -> str:
     """
-    Преобразование аудио в текст через OpenAI Whisper
+    Преобразование аудио в текст через Deepgram (если настроен) или OpenAI Whisper
     """
     try:
         print(f"[STT] Processing: {audio_path}")
@@ -103,12 +278,29 @@ async def speech_to_text(audio_path: str) -> str:
             print("[STT] File too small, likely empty")
             return ""
         
+        if DEEPGRAM_API_KEY:
+            try:
+                text = await deepgram_speech_to_text(audio_path)
+                print(f"[STT] Deepgram result: {text}")
+                return text
+            except Exception as e:
+                print(f"[STT] Deepgram error, falling back to Whisper: {e}")
+        
+        if stt_batcher:
+            try:
+                text = await (await stt_batcher.submit(audio_path))
+                print(f"[STT] Batched result: {text}")
+                return text
+            except Exception as e:
+                print(f"[STT] Batched STT error, falling back to Whisper: {e}")
+        
         with open(audio_path, 'rb') as audio_file:
-            transcript = openai_client.audio.transcriptions.create(
-                model="whisper-1",
-                file=audio_file,
-                language="ru"
-            )
+            async with openai_semaphore:
+                transcript = await openai_client.audio.transcriptions.create(
+                    model="whisper-1",
+                    file=audio_file,
+                    language="ru"
+                )
         
         text = transcript.text
         print(f"[STT] Result: {text}")
@@ -119,25 +311,65 @@ async def speech_to_text(audio_path: str) -> str:
         return ""
 
 
+def match_department(text: str):
+    """
+    Определение отдела по ключевым словам
+    Возвращает None, если совпадений нет или они неоднозначны
+    """
+    matched = {m.lastgroup for m in DEPARTMENT_PATTERN.finditer(text)}
+    if len(matched) == 1:
+        return matched.pop()
+    return None
+
+
+def normalize_text(text: str) -> str:
+    """
+    Нормализация фразы для ключа кэша: нижний регистр, без пунктуации и лишних пробелов
+    """
+    return ' '.join(re.sub(r'[^\w\s]', ' ', text.lower()).split())
+
+
+def routing_cache_key(text: str) -> bytes:
+    """Ключ кэша: модель + системный промпт + нормализованный текст"""
+    raw = f"{ROUTING_MODEL}|{ROUTING_PROMPT}|{normalize_text(text)}"
+    return hashlib.blake2b(raw.encode('utf-8'), digest_size=16).digest()
+
+
 async def get_ai_response(text: str) -> str:
     """
     Получить ответ от OpenAI GPT
+    Сначала пробуем ключевые слова, GPT вызываем только при неуверенности
     """
     try:
         print(f"[AI] Processing: {text}")
         
-        response = openai_client.chat.completions.create(
-            model="gpt-4",
-            messages=[
-                {"role": "system", "content": "Ты — AI ассистент call-центра. Определи, в какой отдел нужно перевести звонок: sales (продажи), support (техподдержка), billing (бухгалтерия). Ответь только названием отдела."},
-                {"role": "user", "content": text}
-            ],
-            max_tokens=50,
-            temperature=0.3
-        )
+        department = match_department(text)
+        if department:
+            print(f"[AI] Keyword match: {department}")
+            return department
+        
+        cache_key = routing_cache_key(text)
+        cached = routing_cache.get(cache_key)
+        if cached:
+            print(f"[AI] Cache hit: {cached}")
+            return cached
+        
+        async with openai_semaphore:
+            response = await openai_client.chat.completions.create(
+                model=ROUTING_MODEL,
+                messages=[
+                    {"role": "system", "content": ROUTING_PROMPT},
+                    {"role": "user", "content": text}
+                ],
+                max_tokens=50,
+                temperature=0.3
+            )
         
         result = response.choices[0].message.content.strip().lower()
         print(f"[AI] Response: {result}")
+        
+        routing_cache[cache_key] = result
+        
         return result
         
     except Exception as e:
@@ -145,20 +377,28 @@ async def get_ai_response(text: str) -> str:
         return "support"
 
 
+def wav_header(data_size: int, sample_rate: int = TTS_SAMPLE_RATE) -> bytes:
+    """
+    RIFF/WAV заголовок для PCM16 mono
+    """
+    return struct.pack(
+        '<4sI4s4sIHHIIHH4sI',
+        b'RIFF', 36 + data_size, b'WAVE',
+        b'fmt ', 16, 1, 1, sample_rate, sample_rate * 2, 2, 16,
+        b'data', data_size
+    )
+
+
 async def text_to_speech(text: str, output_path: str) -> bool:
     """
     Преобразование текста в речь через ElevenLabs
+    Сразу получаем PCM 8kHz и пишем WAV для Asterisk (без MP3 и ffmpeg)
     """
     try:
         print(f"[TTS] Generating speech: {text}")
         
-        url = f"https://api.elevenlabs.io/v1/text-to-speech/{ELEVENLABS_VOICE_ID}"
-        
-        headers = {
-            "Accept": "audio/mpeg",
-            "Content-Type": "application/json",
-            "xi-api-key": ELEVENLABS_API_KEY
-        }
+        url = f"https://api.elevenlabs.io/v1/text-to-speech/{ELEVENLABS_VOICE_ID}/stream"
+        params = {"output_format": TTS_OUTPUT_FORMAT}
         
         data = {
             "text": text,
@@ -169,23 +409,85 @@ async def text_to_speech(text: str, output_path: str) -> bool:
             }
         }
         
-        async with httpx.AsyncClient() as client:
-            response = await client.post(url, json=data, headers=headers, timeout=30.0)
-            
-            if response.status_code == 200:
-                with open(output_path, 'wb') as f:
-                    f.write(response.content)
-                print(f"[TTS] Saved to: {output_path}")
-                return True
-            else:
+        async with TTS_CLIENT.stream("POST", url, params=params, json=data) as response:
+            if response.status_code != 200:
+                await response.aread()
                 print(f"[TTS] Error {response.status_code}: {response.text}")
                 return False
+            
+            # Пишем чанки на диск по мере поступления, не держим весь ответ в памяти.
+            # Заголовок WAV дописываем в конце, когда известен размер данных
+            with open(output_path, 'wb') as f:
+                f.write(wav_header(0))
+                data_size = 0
+                async for chunk in response.aiter_bytes(65536):
+                    f.write(chunk)
+                    data_size += len(chunk)
+                f.seek(0)
+                f.write(wav_header(data_size))
+        
+        print(f"[TTS] Saved to: {output_path} ({data_size} bytes PCM)")
+        return True
                 
     except Exception as e:
         print(f"[TTS] Error: {e}")
         return False
 
 
+def recording_event(call_id: str) -> asyncio.Event:
+    """Event готовности записи для звонка"""
+    event = recording_events.get(call_id)
+    if event is None:
+        event = recording_events[call_id] = asyncio.Event()
+    return event
+
+
+async def watch_recordings():
+    """
+    Следим за /recordings через inotify: как только Asterisk закрыл файл
+    call_{id}.wav, будим обработчик этого звонка
+    """
+    while True:
+        try:
+            with Inotify() as inotify:
+                inotify.add_watch(RECORDINGS_DIR, Mask.CLOSE_WRITE | Mask.MOVED_TO)
+                print(f"[AGI] Watching {RECORDINGS_DIR} for recordings")
+                async for event in inotify:
+                    if event.name is None:
+                        continue
+                    match = RECORDING_NAME_RE.match(event.name.name)
+                    if match:
+                        recording_event(match.group(1)).set()
+        except Exception as e:
+            # Без watcher каждый звонок ждал бы записи полный таймаут - перезапускаем
+            print(f"[AGI] Recordings watcher failed: {e}, restarting in {RECORDING_WATCH_RETRY}s")
+            await asyncio.sleep(RECORDING_WATCH_RETRY)
+
+
+async def prerender_prompts():
+    """
+    Синтез фиксированных фраз при старте, чтобы не ходить в ElevenLabs во время звонка
+    """
+    async def render(name: str, text: str):
+        if await text_to_speech(text, f"/recordings/prompt_{name}.wav"):
+            prompt_cache[name] = f"/var/spool/asterisk/monitor/prompt_{name}"
+    
+    await asyncio.gather(*(render(name, text) for name, text in PROMPT_TEXTS.items()))
+    print(f"[TTS] Prompts ready: {sorted(prompt_cache)}")
+
+
+async def recognize_and_route(audio_path: str):
+    """
+    STT + определение отдела
+    Возвращает (text, department)
+    """
+    text = await speech_to_text(audio_path)
+    if not text:
+        return text, None
+    department = await get_ai_response(text)
+    return text, department
+
+
 async def handle_call(session: AGISession, call_id: str):
     """
     Обработка входящего звонка
@@ -194,20 +496,34 @@ async def handle_call(session: AGISession, call_id: str):
         await session.verbose(f"AI Call Handler started for call {call_id}")
         
         # Путь к записи
-        audio_path = f"/recordings/call_{call_id}.wav"
+        audio_path = f"{RECORDINGS_DIR}/call_{call_id}.wav"
         
-        # Ждём пока файл появится
-        for i in range(10):
-            if os.path.exists(audio_path):
-                break
-            await asyncio.sleep(1)
+        # Ждём пока Asterisk допишет файл (уведомление от inotify).
+        # MixMonitor создаёт файл ещё до AGI, поэтому само наличие файла
+        # ничего не значит - оно проверяется только после таймаута ниже
+        ready = recording_event(call_id)
+        if not ready.is_set():
+            try:
+                await asyncio.wait_for(ready.wait(), timeout=RECORDING_WAIT_TIMEOUT)
+            except asyncio.TimeoutError:
+                print(f"[AGI] No close event for {audio_path} after {RECORDING_WAIT_TIMEOUT}s")
+        recording_events.pop(call_id, None)
         
         if not os.path.exists(audio_path):
             await session.verbose("Recording file not found")
             return
         
-        # Распознаём речь
-        text = await speech_to_text(audio_path)
+        # Распознаём речь и определяем отдел в фоне,
+        # а звонящему тем временем проигрываем заранее синтезированную фразу
+        route_task = asyncio.create_task(recognize_and_route(audio_path))
+        try:
+            if 'stall' in prompt_cache:
+                await session.playback(prompt_cache['stall'])
+        except BaseException:
+            # Звонящий положил трубку - STT и GPT для мёртвого канала не нужны
+            route_task.cancel()
+            raise
+        text, department = await route_task
         
         if not text:
             await session.verbose("No speech detected")
@@ -215,30 +531,21 @@ async def handle_call(session: AGISession, call_id: str):
             return
         
         await session.verbose(f"Recognized: {text}")
-        
-        # Получаем ответ от AI
-        department = await get_ai_response(text)
         await session.verbose(f"Department: {department}")
         
-        # Генерируем ответ
-        response_text = f"Переводю вас в отдел {department}"
-        response_mp3 = f"/recordings/response_{call_id}.mp3"
-        response_wav = f"/recordings/response_{call_id}.wav"
-        response_asterisk = f"/var/spool/asterisk/monitor/response_{call_id}"
-        
-        if await text_to_speech(response_text, response_mp3):
-            # Конвертируем MP3 → WAV для Asterisk
-            try:
-                from pydub import AudioSegment
-                audio = AudioSegment.from_mp3(response_mp3)
-                audio = audio.set_frame_rate(8000).set_channels(1)
-                audio.export(response_wav, format="wav")
-                print(f"[TTS] Converted to WAV: {response_wav}")
-                
+        # Фраза перевода для известных отделов синтезирована при старте
+        cached_prompt = prompt_cache.get(f"transfer_{department}")
+        if cached_prompt:
+            await session.playback(cached_prompt)
+        else:
+            # Генерируем ответ
+            response_text = f"Переводю вас в отдел {department}"
+            response_wav = f"/recordings/response_{call_id}.wav"
+            response_asterisk = f"/var/spool/asterisk/monitor/response_{call_id}"
+            
+            if await text_to_speech(response_text, response_wav):
                 # Проигрываем WAV (без расширения)
                 await session.playback(response_asterisk)
-            except Exception as e:
-                print(f"[TTS] Conversion error: {e}")
         
         # Здесь можно добавить перевод на оператора
         # await session.send_command(f'EXEC Dial PJSIP/{department}@trunk')
@@ -279,6 +586,8 @@ async def main():
     """
     Запуск FastAGI сервера
     """
+    await prerender_prompts()
+    
     print("[AGI] Starting FastAGI server on 0.0.0.0:4573...")
     
     server = await asyncio.start_server(
@@ -290,11 +599,26 @@ async def main():
     addr = server.sockets[0].getsockname()
     print(f"[AGI] Listening on {addr}")
     
-    async with server:
-        await server.serve_forever()
+    watcher_task = asyncio.create_task(watch_recordings())
+    batcher_task = asyncio.create_task(stt_batcher.run()) if stt_batcher else None
+    
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        watcher_task.cancel()
+        if batcher_task:
+            batcher_task.cancel()
+            await stt_batcher.close()
+        await TTS_CLIENT.aclose()
+        if DEEPGRAM_CLIENT:
+            await DEEPGRAM_CLIENT.aclose()
+        if openai_client:
+            await openai_client.close()
 
 
 if __name__ == '__main__':
+    uvloop.install()
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
@@ -4,31 +4,131 @@ Real-time AGI handler с OpenAI Realtime API
 Без записи файлов - прямой стриминг аудио
 """
 import asyncio
+import uvloop
 import socket
-import json
+import struct
+import uuid
 import base64
 import os
-from pathlib import Path
+import time
 import websockets
+import orjson
+from env import load_env
+from g711 import pcm16_to_ulaw, ulaw_to_pcm16
 
-# Manual .env loading
-try:
-    env_path = Path(__file__).parent.parent / '.env'
-    with open(env_path, 'r') as f:
-        for line in f:
-            line = line.strip()
-            if line and not line.startswith('#') and '=' in line:
-                key, value = line.split('=', 1)
-                os.environ[key] = value
-    print("[INIT] Loaded .env for realtime AGI")
-except Exception as e:
-    print(f"[WARN] .env loading: {e}")
+load_env()
 
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 OPENAI_REALTIME_URL = "wss://api.openai.com/v1/realtime?model=gpt-4o-realtime-preview-2024-10-01"
 
+# AudioSocket: Asterisk подключается сюда и стримит аудио звонка (slin, 8000 Hz, mono)
+AUDIOSOCKET_HOST = os.getenv('REALTIME_AUDIOSOCKET_HOST', '127.0.0.1')
+AUDIOSOCKET_PORT = int(os.getenv('REALTIME_AUDIOSOCKET_PORT', '9093'))
+AUDIO_FRAME_BYTES = 320  # 20ms PCM16 @8kHz
+AUDIO_FRAME_INTERVAL = 0.02  # кадр 320 байт - 20ms, отдаём в реальном времени
+AUDIOSOCKET_HEADER = struct.Struct('!BH')  # тип кадра, длина payload
+
 print(f"[INIT] OpenAI API key: {OPENAI_API_KEY[:20] if OPENAI_API_KEY else 'NOT SET'}...")
 
+# Пул заранее открытых сессий Realtime API. Каждая сессия в пуле - открытое
+# платное подключение, поэтому пул выключен по умолчанию (0) и включается явно
+REALTIME_POOL_SIZE = int(os.getenv('REALTIME_POOL_SIZE', '0'))
+# OpenAI закрывает сессию через REALTIME_SESSION_LIFETIME после открытия, время
+# ожидания в пуле идёт в этот же срок. Сессия выдаётся звонку, только если
+# до лимита осталось не меньше REALTIME_CALL_MAX_DURATION
+REALTIME_SESSION_LIFETIME = float(os.getenv('REALTIME_SESSION_LIFETIME', '1800'))
+REALTIME_CALL_MAX_DURATION = float(os.getenv('REALTIME_CALL_MAX_DURATION', '900'))
+REALTIME_SESSION_MAX_AGE = REALTIME_SESSION_LIFETIME - REALTIME_CALL_MAX_DURATION
+REALTIME_CONNECT_TIMEOUT = 10
+
+# Конфигурация сессии
+# g711_ulaw в обе стороны: 8kHz как в телефонии, без ресемплинга
+SESSION_CONFIG = {
+    "type": "session.update",
+    "session": {
+        "modalities": ["text", "audio"],
+        "instructions": "Ты - AI ассистент call-центра. Поздоровайся с клиентом и спроси чем можешь помочь. Определи отдел: sales (продажи), support (техподдержка) или billing (бухгалтерия). Будь очень краток и дружелюбен.",
+        "voice": "alloy",
+        "input_audio_format": "g711_ulaw",
+        "output_audio_format": "g711_ulaw",
+        "input_audio_transcription": {
+            "model": "whisper-1"
+        },
+        "turn_detection": {
+            "type": "server_vad",
+            "threshold": 0.5,
+            "silence_duration_ms": 800
+        }
+    }
+}
+
+# stream_id -> Future с (reader, writer) AudioSocket соединения
+pending_streams = {}
+
+
+class RealtimeSessionPool:
+    """
+    Пул прогретых websocket сессий OpenAI Realtime
+    TLS, handshake и session.update выполняются заранее, а не при ответе на звонок.
+    Сессия отдаётся одному звонку и после него закрывается (в ней история диалога),
+    вместо неё в фоне открывается новая
+    """
+    
+    def __init__(self, size: int = REALTIME_POOL_SIZE):
+        self.size = size
+        self.idle = asyncio.Queue()
+        self.refill_tasks = set()
+        
+    async def open_session(self):
+        """Новое подключение с уже отправленной конфигурацией"""
+        headers = {
+            "Authorization": f"Bearer {OPENAI_API_KEY}",
+            "OpenAI-Beta": "realtime=v1"
+        }
+        # compression=None: deflate на base64 аудио только тратит CPU
+        ws = await asyncio.wait_for(
+            websockets.connect(
+                OPENAI_REALTIME_URL,
+                extra_headers=headers,
+                open_timeout=REALTIME_CONNECT_TIMEOUT,
+                max_size=2**22,
+                compression=None
+            ),
+            timeout=REALTIME_CONNECT_TIMEOUT
+        )
+        await ws.send(orjson.dumps(SESSION_CONFIG).decode())
+        return ws
+        
+    async def refill(self):
+        """Добавить в пул одну прогретую сессию"""
+        try:
+            ws = await self.open_session()
+            await self.idle.put((ws, time.monotonic()))
+        except Exception as e:
+            print(f"[REALTIME] Pool warm-up error: {e}")
+            
+    async def warm_up(self):
+        """Заполнить пул при старте"""
+        if self.size <= 0:
+            return
+        await asyncio.gather(*(self.refill() for _ in range(self.size)))
+        print(f"[REALTIME] Session pool warmed: {self.idle.qsize()}/{self.size}")
+        
+    async def acquire(self):
+        """Взять прогретую сессию, либо подключиться сразу если пул пуст"""
+        while not self.idle.empty():
+            ws, created_at = self.idle.get_nowait()
+            task = asyncio.create_task(self.refill())
+            self.refill_tasks.add(task)
+            task.add_done_callback(self.refill_tasks.discard)
+            if ws.open and time.monotonic() - created_at < REALTIME_SESSION_MAX_AGE:
+                return ws
+            await ws.close()
+        return await self.open_session()
+
+
+realtime_pool = RealtimeSessionPool()
+
 
 class AGISession:
     """AGI session handler"""
@@ -41,13 +141,11 @@ class AGISession:
     async def read_agi_env(self):
         """Read AGI environment variables"""
         print("[AGI] Reading environment...")
-        while True:
-            line = await self.reader.readline()
-            line = line.decode('utf-8').strip()
-            if not line:
-                break
-            if ':' in line:
-                key, value = line.split(':', 1)
+        # Окружение заканчивается пустой строкой - читаем блок целиком за один раз
+        blob = await self.reader.readuntil(b"\n\n")
+        for line in blob.decode('utf-8').splitlines():
+            key, sep, value = line.partition(':')
+            if sep:
                 self.agi_vars[key.strip()] = value.strip()
         print(f"[AGI] Environment loaded: {len(self.agi_vars)} vars")
         
@@ -77,54 +175,143 @@ class AGISession:
         return await self.send_command(f'STREAM FILE {file_path} ""')
 
 
+async def asterisk_to_openai(reader, ws):
+    """
+    AudioSocket → OpenAI: PCM16 от Asterisk кодируем в μ-law и шлём в input buffer
+    """
+    frame_count = 0
+    try:
+        while True:
+            header = await reader.readexactly(3)
+            frame_type = header[0]
+            length = (header[1] << 8) | header[2]
+            payload = await reader.readexactly(length) if length else b''
+            
+            if frame_type == 0x10:  # Audio
+                frame_count += 1
+                event = {
+                    "type": "input_audio_buffer.append",
+                    "audio": base64.b64encode(pcm16_to_ulaw(payload)).decode('utf-8')
+                }
+                await ws.send(orjson.dumps(event).decode())
+            elif frame_type == 0x00:  # Hangup
+                print(f"[REALTIME] Hangup after {frame_count} frames")
+                break
+            elif frame_type == 0xff:  # Error
+                print(f"[REALTIME] AudioSocket error frame: {payload.hex()}")
+                break
+    except asyncio.IncompleteReadError:
+        print(f"[REALTIME] AudioSocket closed by Asterisk ({frame_count} frames)")
+
+
+async def openai_to_asterisk(ws, writer):
+    """
+    OpenAI → AudioSocket: μ-law дельты ответа декодируем в PCM16 и режем на 20ms кадры
+    """
+    deadline = time.monotonic()
+    async for message in ws:
+        event = orjson.loads(message)
+        event_type = event.get("type")
+        
+        if event_type == "response.audio.delta":
+            pcm = ulaw_to_pcm16(base64.b64decode(event.get("delta", "")))
+            # После паузы между дельтами отсчёт идёт от текущего момента, а не догоняет
+            deadline = max(deadline, time.monotonic())
+            for offset in range(0, len(pcm), AUDIO_FRAME_BYTES):
+                frame = pcm[offset:offset + AUDIO_FRAME_BYTES]
+                writer.writelines((AUDIOSOCKET_HEADER.pack(0x10, len(frame)), frame))
+                # Темп по абсолютному дедлайну: время записи не копится в дрейф
+                deadline += AUDIO_FRAME_INTERVAL
+                await asyncio.sleep(max(deadline - time.monotonic(), 0))
+            await writer.drain()
+                
+        elif event_type == "response.audio_transcript.done":
+            print(f"[REALTIME] AI: {event.get('transcript', '')}")
+            
+        elif event_type == "conversation.item.input_audio_transcription.completed":
+            print(f"[REALTIME] Caller: {event.get('transcript', '')}")
+            
+        elif event_type == "error":
+            print(f"[REALTIME] Error: {event}")
+
+
 async def handle_realtime_call(session: AGISession, call_id: str):
     """
     Real-time обработка звонка через OpenAI Realtime API
+    Аудио звонка идёт через AudioSocket, один websocket вместо STT → GPT → TTS
     """
     await session.verbose(f"Real-time AI Call Handler for {call_id}")
     
-    # Подключаемся к OpenAI Realtime API
-    headers = {
-        "Authorization": f"Bearer {OPENAI_API_KEY}",
-        "OpenAI-Beta": "realtime=v1"
-    }
+    stream_id = str(uuid.uuid4())
+    connected = asyncio.get_running_loop().create_future()
+    pending_streams[stream_id] = connected
+    ws = None
+    agi_task = None
     
     try:
-        async with websockets.connect(OPENAI_REALTIME_URL, extra_headers=headers) as ws:
-            print(f"[REALTIME] Connected to OpenAI for call {call_id}")
-            
-            # Конфигурация сессии
-            config = {
-                "type": "session.update",
-                "session": {
-                    "modalities": ["text", "audio"],
-                    "instructions": "Ты - AI ассистент call-центра. Поздоровайся с клиентом и спроси чем можешь помочь. Определи отдел: sales (продажи), support (техподдержка) или billing (бухгалтерия). Будь очень краток и дружелюбен.",
-                    "voice": "alloy",
-                    "input_audio_format": "pcm16",
-                    "output_audio_format": "pcm16",
-                    "input_audio_transcription": {
-                        "model": "whisper-1"
-                    },
-                    "turn_detection": {
-                        "type": "server_vad",
-                        "threshold": 0.5,
-                        "silence_duration_ms": 800
-                    }
-                }
-            }
-            
-            await ws.send(json.dumps(config))
-            await session.verbose("OpenAI Realtime API connected")
-            
-            # TODO: Здесь нужно получать аудио chunks от Asterisk
-            # и отправлять в OpenAI, а ответ возвращать обратно
-            
-            # Пока просто ждём и вешаем трубку
-            await asyncio.sleep(10)
-            
+        # Берём заранее подключённую и настроенную сессию OpenAI Realtime
+        ws = await realtime_pool.acquire()
+        print(f"[REALTIME] OpenAI session ready for call {call_id}")
+        await session.verbose("OpenAI Realtime API connected")
+        
+        # Asterisk открывает AudioSocket к нам; команда возвращается после завершения стрима
+        agi_task = asyncio.create_task(
+            session.send_command(f'EXEC AudioSocket {stream_id},{AUDIOSOCKET_HOST}:{AUDIOSOCKET_PORT}')
+        )
+        reader, writer = await asyncio.wait_for(connected, timeout=5.0)
+        
+        try:
+            tasks = [
+                asyncio.create_task(asterisk_to_openai(reader, ws)),
+                asyncio.create_task(openai_to_asterisk(ws, writer)),
+            ]
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in tasks:
+                task.cancel()
+        finally:
+            writer.close()
+            await writer.wait_closed()
+        
+        await agi_task
+        
     except Exception as e:
         print(f"[REALTIME] Error: {e}")
-        await session.verbose(f"Error: {e}")
+        # Пока EXEC AudioSocket ждёт ответа, AGI канал занят - вторую команду не шлём
+        if agi_task is None or agi_task.done():
+            await session.verbose(f"Error: {e}")
+    finally:
+        if agi_task and not agi_task.done():
+            # AudioSocket так и не подключился (таймаут) - не оставляем висящую команду
+            agi_task.cancel()
+            await asyncio.gather(agi_task, return_exceptions=True)
+        pending_streams.pop(stream_id, None)
+        # Сессия хранит диалог звонка - повторно не используем
+        if ws:
+            await ws.close()
+
+
+async def handle_audiosocket(reader, writer):
+    """
+    Входящее AudioSocket соединение: первый кадр - UUID, по нему находим звонок
+    """
+    try:
+        header = await reader.readexactly(3)
+        frame_type, length = AUDIOSOCKET_HEADER.unpack(header)
+        payload = await reader.readexactly(length)
+    except asyncio.IncompleteReadError:
+        writer.close()
+        return
+    
+    stream_id = str(uuid.UUID(bytes=payload)) if frame_type == 0x01 and length == 16 else None
+    connected = pending_streams.get(stream_id)
+    
+    if connected is None or connected.done():
+        print(f"[AUDIOSOCKET] Unknown stream: {stream_id}")
+        writer.close()
+        return
+    
+    # Дальше соединением владеет handle_realtime_call
+    connected.set_result((reader, writer))
 
 
 async def handle_agi_client(reader, writer):
@@ -151,6 +338,8 @@ async def handle_agi_client(reader, writer):
 
 async def main():
     """Запуск FastAGI сервера"""
+    await realtime_pool.warm_up()
+    
     print("[AGI-REALTIME] Starting FastAGI server on 0.0.0.0:4573...")
     
     server = await asyncio.start_server(
@@ -159,14 +348,22 @@ async def main():
         4573
     )
     
+    audiosocket_server = await asyncio.start_server(
+        handle_audiosocket,
+        '0.0.0.0',
+        AUDIOSOCKET_PORT
+    )
+    
     addr = server.sockets[0].getsockname()
     print(f"[AGI-REALTIME] Listening on {addr}")
+    print(f"[AGI-REALTIME] AudioSocket on {audiosocket_server.sockets[0].getsockname()}")
     
-    async with server:
-        await server.serve_forever()
+    async with server, audiosocket_server:
+        await asyncio.gather(server.serve_forever(), audiosocket_server.serve_forever())
 
 
 if __name__ == '__main__':
+    uvloop.install()
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
@@ -3,24 +3,15 @@
 ARI Real-time обработчик для стриминга аудио в OpenAI
 """
 import asyncio
-import json
+import uvloop
 import os
 import base64
-from pathlib import Path
 import httpx
 import websockets
+import orjson
+from env import load_env
 
-# Manual .env loading
-try:
-    env_path = Path(__file__).parent.parent / '.env'
-    with open(env_path, 'r') as f:
-        for line in f:
-            line = line.strip()
-            if line and not line.startswith('#') and '=' in line:
-                key, value = line.split('=', 1)
-                os.environ[key] = value
-except Exception as e:
-    print(f"[WARN] .env loading: {e}")
+load_env()
 
 # Configuration
 ASTERISK_HOST = os.getenv('ASTERISK_HOST', 'localhost')
@@ -31,10 +22,37 @@ ASTERISK_ARI_PASSWORD = 'python_ai_secret'
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 OPENAI_REALTIME_URL = "wss://api.openai.com/v1/realtime?model=gpt-4o-realtime-preview-2024-10-01"
 
+# Подключение websocket: таймаут на попытку и повторы с экспоненциальной паузой
+WS_CONNECT_TIMEOUT = 10
+WS_CONNECT_RETRIES = 3
+WS_CONNECT_BACKOFF = 0.5
+
 print(f"[INIT] Asterisk ARI: {ASTERISK_HOST}:{ASTERISK_ARI_PORT}")
 print(f"[INIT] OpenAI API key: {OPENAI_API_KEY[:20] if OPENAI_API_KEY else 'NOT SET'}...")
 
 
+async def connect_ws(url: str, **kwargs):
+    """
+    websockets.connect с ограничением по времени и повторами,
+    чтобы недоступный сервер не подвешивал обработчик навсегда
+    """
+    delay = WS_CONNECT_BACKOFF
+    for attempt in range(1, WS_CONNECT_RETRIES + 1):
+        try:
+            return await asyncio.wait_for(
+                websockets.connect(url, open_timeout=WS_CONNECT_TIMEOUT, **kwargs),
+                timeout=WS_CONNECT_TIMEOUT
+            )
+        except (OSError, asyncio.TimeoutError, websockets.InvalidStatusCode) as e:
+            # 4xx (неверный ключ, креды ARI) повтором не исправить - сразу наверх
+            client_error = isinstance(e, websockets.InvalidStatusCode) and e.status_code < 500
+            if client_error or attempt == WS_CONNECT_RETRIES:
+                raise
+            print(f"[WS] Connect attempt {attempt} failed: {e}, retry in {delay}s")
+            await asyncio.sleep(delay)
+            delay *= 2
+
+
 class ARIRealtimeHandler:
     """Real-time обработка звонков через Asterisk ARI + OpenAI"""
     
@@ -42,6 +60,12 @@ class ARIRealtimeHandler:
         self.ari_ws = None
         self.openai_ws = None
         self.active_channels = {}
+        # Один HTTP клиент ARI на всё время работы (keep-alive между звонками)
+        self.http = httpx.AsyncClient(
+            auth=(ASTERISK_ARI_USER, ASTERISK_ARI_PASSWORD),
+            base_url=f"http://{ASTERISK_HOST}:{ASTERISK_ARI_PORT}",
+            limits=httpx.Limits(max_keepalive_connections=64)
+        )
         
     async def connect_ari(self):
         """Подключение к Asterisk ARI WebSocket"""
@@ -55,7 +79,7 @@ class ARIRealtimeHandler:
         
         try:
             # WebSocket с subprotocol "ari" как требует Asterisk
-            self.ari_ws = await websockets.connect(
+            self.ari_ws = await connect_ws(
                 ari_url,
                 subprotocols=["ari"]
             )
@@ -73,9 +97,12 @@ class ARIRealtimeHandler:
         }
         
         try:
-            self.openai_ws = await websockets.connect(
+            # compression=None: deflate на base64 аудио только тратит CPU
+            self.openai_ws = await connect_ws(
                 OPENAI_REALTIME_URL,
-                extra_headers=headers
+                extra_headers=headers,
+                max_size=2**22,
+                compression=None
             )
             
             # Конфигурация сессии
@@ -99,7 +126,7 @@ class ARIRealtimeHandler:
                 }
             }
             
-            await self.openai_ws.send(json.dumps(config))
+            await self.openai_ws.send(orjson.dumps(config).decode())
             print("[OPENAI] Connected to Realtime API")
             return True
             
@@ -119,29 +146,25 @@ class ARIRealtimeHandler:
             
         try:
             # Создаём external media channel для получения аудио
-            async with httpx.AsyncClient() as client:
-                # Создаём snoop для получения аудио
-                snoop_url = f"http://{ASTERISK_HOST}:{ASTERISK_ARI_PORT}/ari/channels/{channel_id}/snoop"
-                auth = (ASTERISK_ARI_USER, ASTERISK_ARI_PASSWORD)
-                
-                params = {
-                    "spy": "in",  # Получаем входящее аудио
-                    "whisper": "out",  # Отправляем исходящее аудио
-                    "app": "realtime_ai",
-                    "snoopId": f"snoop-{channel_id}"
-                }
+            # Создаём snoop для получения аудио
+            params = {
+                "spy": "in",  # Получаем входящее аудио
+                "whisper": "out",  # Отправляем исходящее аудио
+                "app": "realtime_ai",
+                "snoopId": f"snoop-{channel_id}"
+            }
+            
+            response = await self.http.post(f"/ari/channels/{channel_id}/snoop", params=params)
+            
+            if response.status_code == 200:
+                snoop_data = response.json()
+                print(f"[SNOOP] Created: {snoop_data}")
                 
-                response = await client.post(snoop_url, auth=auth, params=params)
+                # TODO: Получаем RTP поток и стримим в OpenAI
+                # Это требует дополнительной настройки external media
                 
-                if response.status_code == 200:
-                    snoop_data = response.json()
-                    print(f"[SNOOP] Created: {snoop_data}")
-                    
-                    # TODO: Получаем RTP поток и стримим в OpenAI
-                    # Это требует дополнительной настройки external media
-                    
-                else:
-                    print(f"[SNOOP] Error {response.status_code}: {response.text}")
+            else:
+                print(f"[SNOOP] Error {response.status_code}: {response.text}")
                     
         except Exception as e:
             print(f"[ERROR] Channel handling: {e}")
@@ -159,7 +182,7 @@ class ARIRealtimeHandler:
         try:
             async for message in self.ari_ws:
                 try:
-                    event = json.loads(message)
+                    event = orjson.loads(message)
                     event_type = event.get('type')
                     
                     if event_type == 'StasisStart':
@@ -170,8 +193,11 @@ class ARIRealtimeHandler:
                         
                         print(f"[EVENT] StasisStart: {channel_id} from {caller_number}")
                         
-                        # Обрабатываем канал в отдельной задаче
-                        asyncio.create_task(self.handle_channel(channel_id, caller_number))
+                        # Обрабатываем канал в отдельной задаче; запись уходит
+                        # из active_channels при любом завершении, в т.ч. с ошибкой
+                        task = asyncio.create_task(self.handle_channel(channel_id, caller_number))
+                        self.active_channels[channel_id] = task
+                        task.add_done_callback(lambda _, cid=channel_id: self.active_channels.pop(cid, None))
                         
                     elif event_type == 'StasisEnd':
                         # Звонок завершён
@@ -192,7 +218,10 @@ class ARIRealtimeHandler:
     async def run(self):
         """Запуск обработчика"""
         print("[REALTIME] Starting ARI Real-time handler...")
-        await self.listen_events()
+        try:
+            await self.listen_events()
+        finally:
+            await self.http.aclose()
 
 
 async def main():
@@ -202,6 +231,7 @@ async def main():
 
 
 if __name__ == '__main__':
+    uvloop.install()
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
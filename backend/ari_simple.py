@@ -4,26 +4,21 @@
 """
 import ari
 import os
+import time
 import asyncio
-from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from env import load_env
 
-# Manual .env loading
-try:
-    env_path = Path(__file__).parent.parent / '.env'
-    with open(env_path, 'r') as f:
-        for line in f:
-            line = line.strip()
-            if line and not line.startswith('#') and '=' in line:
-                key, value = line.split('=', 1)
-                os.environ[key] = value
-    print("[INIT] Loaded .env")
-except Exception as e:
-    print(f"[WARN] .env loading: {e}")
+load_env()
 
 ASTERISK_HOST = os.getenv('ASTERISK_HOST', '127.0.0.1')
 ASTERISK_ARI_PORT = os.getenv('ASTERISK_ARI_PORT', '8088')
 ASTERISK_ARI_USER = 'python_ai'
 ASTERISK_ARI_PASSWORD = 'python_ai_secret'
+ARI_MAX_CALLS = int(os.getenv('ARI_MAX_CALLS', '32'))
+
+# Звонки обрабатываются в пуле потоков, чтобы не блокировать диспетчер событий ari-py
+call_executor = ThreadPoolExecutor(max_workers=ARI_MAX_CALLS, thread_name_prefix='ari-call')
 
 print(f"[INIT] Connecting to ARI: http://{ASTERISK_HOST}:{ASTERISK_ARI_PORT}")
 
@@ -37,6 +32,27 @@ try:
     
     print("[ARI] ✅ Connected!")
     
+    def handle_call(channel_id, caller):
+        """Обработка звонка (выполняется в пуле потоков)"""
+        try:
+            # Отвечаем на звонок
+            channel = client.channels.get(channelId=channel_id)
+            channel.answer()
+            
+            print(f"[CALL] Answered!")
+            
+            # Здесь можно добавить real-time обработку
+            # Например, проигрывание звука или получение аудио
+            
+            # Пока просто держим линию 5 секунд
+            time.sleep(5)
+            
+            # Вешаем трубку
+            channel.hangup()
+            print(f"[CALL] Hangup")
+        except Exception as e:
+            print(f"[CALL] Error on {channel_id}: {e}")
+    
     def on_start(channel_obj, event):
         """Обработка входящего звонка"""
         channel_id = event['channel']['id']
@@ -44,22 +60,8 @@ try:
         
         print(f"[CALL] Incoming from {caller}, channel: {channel_id}")
         
-        # Отвечаем на звонок
-        channel = client.channels.get(channelId=channel_id)
-        channel.answer()
-        
-        print(f"[CALL] Answered!")
-        
-        # Здесь можно добавить real-time обработку
-        # Например, проигрывание звука или получение аудио
-        
-        # Пока просто держим линию 5 секунд
-        import time
-        time.sleep(5)
-        
-        # Вешаем трубку
-        channel.hangup()
-        print(f"[CALL] Hangup")
+        # Сразу возвращаемся, чтобы диспетчер мог принять следующие звонки
+        call_executor.submit(handle_call, channel_id, caller)
     
     # Регистрируем обработчик
     client.on_channel_event('StasisStart', on_start)
@@ -4,13 +4,116 @@ Asterisk <-> ElevenLabs Conversational AI Bridge
 Real-time audio streaming между Asterisk и ElevenLabs
 """
 import asyncio
-import socket
+import uvloop
 import struct
+import random
+import time
+import numpy as np
+from scipy import signal
 from elevenlabs_conv_ai import ElevenLabsConvAI
+from g711 import PCM16_TO_ULAW, pcm16_to_ulaw
 
 # Asterisk External Media передаёт RTP напрямую
 # Формат: PCM16, 8000 Hz, mono
 
+RTP_QUEUE_SIZE = 50  # ~1 секунда аудио по 20ms
+
+# RTP header: V/P/X/CC, M/PT, sequence, timestamp, SSRC
+RTP_HEADER = struct.Struct('!BBHII')
+RTP_VERSION = 0x80
+RTP_PAYLOAD_PCMU = 0
+RTP_FRAME_SAMPLES = 160  # 20ms при 8000 Hz
+RTP_FRAME_INTERVAL = 0.02
+
+RTP_SAMPLE_RATE = 8000
+
+
+class StreamingDownsampler:
+    """
+    PCM16 (8000 * factor Hz) → G.711 µ-law 8kHz для потока ответа одного звонка
+    Состояние FIR и фаза прореживания переносятся между пачками, поэтому
+    на стыках пачек разного размера нет щелчков
+    """
+    
+    def __init__(self, factor: int):
+        self.factor = factor
+        # ФНЧ перед прореживанием (для 16000 → 8000 тот же, что в audiosocket_server)
+        self.taps = signal.firwin(31 * factor + 1, 1 / factor, window=('kaiser', 5.0))
+        self.state = np.zeros(len(self.taps) - 1)
+        self.phase = 0  # индекс первого оставляемого сэмпла в следующей пачке
+        
+    def __call__(self, pcm16: bytes) -> bytes:
+        samples = np.frombuffer(pcm16, dtype='<i2')
+        filtered, self.state = signal.lfilter(self.taps, 1.0, samples, zi=self.state)
+        decimated = filtered[self.phase::self.factor]
+        self.phase = (self.phase - len(samples)) % self.factor
+        np.rint(decimated, out=decimated)
+        np.clip(decimated, -32768, 32767, out=decimated)
+        return PCM16_TO_ULAW.take(decimated.astype('<i2').view(np.uint16)).tobytes()
+
+
+def make_output_transcoder(output_format: str):
+    """
+    Перекодировщик agent_output_audio_format → µ-law 8000 Hz для RTP PCMU
+    None - формат уже совпадает с PCMU, байты идут в пакеты как есть.
+    ValueError - формат не перекодировать (частота не кратна 8000 Hz):
+    отправить его как PCMU значит выдать звонящему шум
+    """
+    if output_format == 'ulaw_8000':
+        return None
+    codec, _, rate = (output_format or '').partition('_')
+    if codec == 'pcm' and rate.isdigit() and int(rate) % RTP_SAMPLE_RATE == 0:
+        factor = int(rate) // RTP_SAMPLE_RATE
+        return pcm16_to_ulaw if factor == 1 else StreamingDownsampler(factor)
+    raise ValueError(f"unsupported agent output audio format: {output_format}")
+
+
+class RTPProtocol(asyncio.DatagramProtocol):
+    """
+    Приём RTP пакетов от Asterisk: payload кладётся в очередь
+    """
+    
+    def __init__(self, queue: asyncio.Queue):
+        self.queue = queue
+        self.ssrc = None
+        self.next_seq = None
+        self.lost = 0
+        self.remote_addr = None
+        
+    def datagram_received(self, data, addr):
+        # RTP header: 12 байт (+4 на каждый CSRC), дальше идёт payload
+        if len(data) < RTP_HEADER.size:
+            return
+        first, _, seq, _, ssrc = RTP_HEADER.unpack_from(data)
+        if first >> 6 != 2:  # не RTP v2
+            return
+        
+        # Отвечаем туда, откуда Asterisk шлёт RTP
+        self.remote_addr = addr
+        
+        if ssrc != self.ssrc:
+            self.ssrc = ssrc
+        else:
+            gap = (seq - self.next_seq) & 0xFFFF
+            if 0 < gap < 0x8000:  # пропуск вперёд, а не переупорядоченный пакет
+                self.lost += gap
+        self.next_seq = (seq + 1) & 0xFFFF
+        
+        # memoryview: payload без копирования, bytes появятся только при кодировании для WS
+        payload = memoryview(data)[RTP_HEADER.size + 4 * (first & 0x0F):]
+        if first & 0x20:
+            # Бит P: последний байт - длина padding, его не отправляем как аудио
+            padding = data[-1]
+            if not 0 < padding <= len(payload):
+                return
+            payload = payload[:len(payload) - padding]
+        try:
+            self.queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            # ElevenLabs не успевает - отбрасываем пакет, а не копим задержку
+            pass
+
+
 class AsteriskElevenLabsBridge:
     """
     Мост между Asterisk RTP и ElevenLabs WebSocket
@@ -19,13 +122,17 @@ class AsteriskElevenLabsBridge:
     def __init__(self, rtp_port: int = 10000):
         self.rtp_port = rtp_port
         self.elevenlabs = ElevenLabsConvAI()
-        self.rtp_socket = None
+        self.rtp_transport = None
+        self.rtp_protocol = None
+        self.rtp_queue = asyncio.Queue(maxsize=RTP_QUEUE_SIZE)
         
     async def start_rtp_listener(self):
         """Запуск RTP listener для получения аудио от Asterisk"""
-        self.rtp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.rtp_socket.bind(('0.0.0.0', self.rtp_port))
-        self.rtp_socket.setblocking(False)
+        loop = asyncio.get_running_loop()
+        self.rtp_transport, self.rtp_protocol = await loop.create_datagram_endpoint(
+            lambda: RTPProtocol(self.rtp_queue),
+            local_addr=('0.0.0.0', self.rtp_port)
+        )
         
         print(f"[RTP] Listening on port {self.rtp_port}")
         
@@ -37,22 +144,33 @@ class AsteriskElevenLabsBridge:
         if not await self.elevenlabs.connect():
             return
         
+        try:
+            transcode = make_output_transcoder(self.elevenlabs.agent_output_audio_format)
+        except ValueError as e:
+            print(f"[BRIDGE] ❌ {e}, set the agent output to ulaw_8000 or pcm_8000/16000")
+            await self.elevenlabs.close()
+            return
+        
         print("[BRIDGE] Starting audio bridge...")
         
-        try:
+        tasks = [
             # Задача 1: Получение RTP от Asterisk → отправка в ElevenLabs
-            asyncio.create_task(self.rtp_to_elevenlabs())
-            
+            asyncio.create_task(self.rtp_to_elevenlabs()),
             # Задача 2: Получение ответа от ElevenLabs → отправка в Asterisk RTP
-            asyncio.create_task(self.elevenlabs_to_rtp())
-            
+            asyncio.create_task(self.elevenlabs_to_rtp(transcode)),
+        ]
+        
+        try:
             # Держим соединение
             await asyncio.sleep(60)  # Максимум 60 секунд на звонок
             
         finally:
+            for task in tasks:
+                task.cancel()
             await self.elevenlabs.close()
-            if self.rtp_socket:
-                self.rtp_socket.close()
+            if self.rtp_transport:
+                self.rtp_transport.close()
+                print(f"[RTP] Call ended, lost packets: {self.rtp_protocol.lost}")
                 
     async def rtp_to_elevenlabs(self):
         """Получение RTP от Asterisk и отправка в ElevenLabs"""
@@ -60,20 +178,8 @@ class AsteriskElevenLabsBridge:
         
         while True:
             try:
-                # Получаем RTP пакет (неблокирующе)
-                await asyncio.sleep(0.02)  # 20ms
-                
-                try:
-                    data, addr = self.rtp_socket.recvfrom(2048)
-                except BlockingIOError:
-                    continue
-                
-                # Парсим RTP пакет
-                if len(data) < 12:
-                    continue
-                    
-                # RTP header: 12 байт, дальше идёт payload
-                payload = data[12:]
+                # Ждём следующий RTP payload (пакеты доставляет RTPProtocol)
+                payload = await self.rtp_queue.get()
                 
                 # Отправляем аудио в ElevenLabs
                 await self.elevenlabs.send_audio(payload)
@@ -82,17 +188,63 @@ class AsteriskElevenLabsBridge:
                 print(f"[BRIDGE] RTP error: {e}")
                 break
                 
-    async def elevenlabs_to_rtp(self):
-        """Получение ответа от ElevenLabs и отправка в Asterisk RTP"""
+    async def elevenlabs_to_rtp(self, transcode):
+        """
+        Получение ответа от ElevenLabs и отправка в Asterisk RTP
+        transcode: перекодировщик в µ-law от make_output_transcoder (None - без перекодирования)
+        """
         print("[BRIDGE] ElevenLabs → RTP started")
         
-        text, audio_chunks = await self.elevenlabs.receive_response()
-        
-        print(f"[BRIDGE] Got response: {len(audio_chunks)} chunks")
+        stream_task = asyncio.create_task(self.elevenlabs.stream_responses())
         
-        # TODO: Отправка аудио обратно в Asterisk через RTP
-        # Это требует создания RTP пакетов с правильными заголовками
+        ssrc = random.getrandbits(32)
+        seq = random.getrandbits(16)
+        timestamp = random.getrandbits(32)
+        marker = 0x80  # первый пакет ответа
+        buffer = bytearray()
+        deadline = time.monotonic()
         
+        try:
+            while True:
+                # Забираем сразу все накопившиеся чанки: один переход в поток
+                # на пачку вместо перехода на каждый чанк
+                batch = await self.elevenlabs.drain_audio()
+                response_end = batch[-1] is None
+                if response_end:
+                    batch.pop()
+                
+                if batch and transcode:
+                    # Ресемплинг + кодирование - CPU работа, выносим из event loop,
+                    # чтобы не задерживать отправку RTP других задач
+                    buffer += await asyncio.to_thread(transcode, b''.join(batch))
+                elif batch:
+                    buffer += b''.join(batch)
+                addr = self.rtp_protocol.remote_addr
+                if addr is None:
+                    # Asterisk ещё не прислал ни одного пакета - некуда отвечать
+                    buffer.clear()
+                    continue
+                
+                # После паузы в ответе отсчёт идёт от текущего момента, а не догоняет
+                deadline = max(deadline, time.monotonic())
+                while len(buffer) >= RTP_FRAME_SAMPLES:
+                    header = RTP_HEADER.pack(RTP_VERSION, marker | RTP_PAYLOAD_PCMU, seq, timestamp, ssrc)
+                    self.rtp_transport.sendto(header + buffer[:RTP_FRAME_SAMPLES], addr)
+                    del buffer[:RTP_FRAME_SAMPLES]
+                    seq = (seq + 1) & 0xFFFF
+                    timestamp = (timestamp + RTP_FRAME_SAMPLES) & 0xFFFFFFFF
+                    marker = 0
+                    # Темп по абсолютному дедлайну: время отправки не копится в дрейф
+                    deadline += RTP_FRAME_INTERVAL
+                    await asyncio.sleep(max(deadline - time.monotonic(), 0))
+                
+                if response_end:
+                    # Конец ответа агента - следующий пакет снова с маркером
+                    buffer.clear()
+                    marker = 0x80
+        finally:
+            stream_task.cancel()
+
 
 async def main():
     """Тест моста"""
@@ -102,5 +254,6 @@ async def main():
 
 
 if __name__ == '__main__':
+    uvloop.install()
     asyncio.run(main())
 
@@ -4,64 +4,88 @@ AudioSocket Server для real-time streaming Asterisk ↔ ElevenLabs
 Asterisk передаёт аудио через TCP на порт 9092
 """
 import asyncio
+import uvloop
+import socket
 import struct
 import uuid
 import sys
 import time
 import numpy as np
 from scipy import signal
-from pathlib import Path
 import os
-import audioop
+from env import load_env
+from g711 import PCM16_TO_ULAW
 
 # Unbuffered output
 sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', buffering=1)
 sys.stderr = os.fdopen(sys.stderr.fileno(), 'w', buffering=1)
 
 
-def resample_8k_to_16k(audio_8k: bytes) -> bytes:
+# ФНЧ для ресемплинга 8k → 16k (StreamingUpsampler) считается один раз при старте
+RESAMPLE_FIR = signal.firwin(63, 0.5, window=('kaiser', 5.0))
+
+
+def float_to_pcm16(samples: np.ndarray) -> bytes:
     """
-    Конвертация PCM16 8kHz → 16kHz для ElevenLabs
+    Результат фильтра (float64) → bytes PCM16
+    Округление и ограничение диапазона делаются на месте, копия одна - сразу в int16
     """
-    # Конвертируем bytes → numpy array
-    audio_array = np.frombuffer(audio_8k, dtype=np.int16)
-    
-    # Resample 8000 → 16000 Hz (увеличиваем в 2 раза)
-    resampled = signal.resample(audio_array, len(audio_array) * 2)
-    
-    # Конвертируем обратно в int16
-    resampled_int16 = resampled.astype(np.int16)
-    
-    return resampled_int16.tobytes()
+    np.rint(samples, out=samples)
+    np.clip(samples, -32768, 32767, out=samples)
+    return samples.astype('<i2').tobytes()
 
 
-def resample_16k_to_8k(audio_16k: bytes) -> bytes:
+def frame_rms(pcm: bytes) -> int:
     """
-    Конвертация PCM16 16kHz → 8kHz для Asterisk
+    RMS кадра PCM16 (то же значение, что audioop.rms)
+    Один проход: скалярное произведение кадра на себя
+    """
+    samples = np.frombuffer(pcm, dtype=np.int16).astype(np.int64)
+    if not len(samples):
+        return 0
+    return int(np.sqrt(np.dot(samples, samples) / len(samples)))
+
+
+class UlawEncoder:
+    """
+    PCM16 → μ-law в буфер звонка
+    Таблица пишет прямо в заранее выделенный массив, кадр не создаёт новых буферов.
+    Результат - view на этот массив, действителен до следующего вызова
     """
-    # Конвертируем bytes → numpy array
-    audio_array = np.frombuffer(audio_16k, dtype=np.int16)
     
-    # Resample 16000 → 8000 Hz (уменьшаем в 2 раза)
-    resampled = signal.resample(audio_array, len(audio_array) // 2)
+    def __init__(self, frame_samples: int = 160):
+        self.out = np.empty(frame_samples, dtype=np.uint8)
+        
+    def __call__(self, pcm: bytes) -> np.ndarray:
+        samples = np.frombuffer(pcm, dtype='<u2')
+        if len(samples) > len(self.out):
+            self.out = np.empty(len(samples), dtype=np.uint8)
+        out = self.out[:len(samples)]
+        PCM16_TO_ULAW.take(samples, out=out)
+        return out
+
+
+class StreamingUpsampler:
+    """
+    PCM16 8kHz → 16kHz для потока кадров одного звонка
+    Состояние FIR переносится между кадрами, поэтому на стыках
+    20ms кадров нет щелчков, как при независимом ресемплинге каждого
+    """
     
-    # Конвертируем обратно в int16
-    resampled_int16 = resampled.astype(np.int16)
+    # Вставка нулей между сэмплами вдвое снижает уровень - компенсируем в фильтре
+    TAPS = RESAMPLE_FIR * 2
     
-    return resampled_int16.tobytes()
-
-# Manual .env loading
-try:
-    env_path = Path(__file__).parent.parent / '.env'
-    with open(env_path, 'r') as f:
-        for line in f:
-            line = line.strip()
-            if line and not line.startswith('#') and '=' in line:
-                key, value = line.split('=', 1)
-                os.environ[key] = value
-    print("[INIT] Loaded .env for AudioSocket")
-except Exception as e:
-    print(f"[WARN] .env loading: {e}")
+    def __init__(self):
+        self.state = np.zeros(len(self.TAPS) - 1)
+        
+    def __call__(self, audio_8k: bytes) -> bytes:
+        samples = np.frombuffer(audio_8k, dtype=np.int16)
+        upsampled = np.zeros(len(samples) * 2)
+        upsampled[::2] = samples
+        filtered, self.state = signal.lfilter(self.TAPS, 1.0, upsampled, zi=self.state)
+        return float_to_pcm16(filtered)
+
+load_env()
 
 # Импортируем ElevenLabs Conversational AI
 from elevenlabs_conv_ai import ElevenLabsConvAI
@@ -70,6 +94,33 @@ from elevenlabs_conv_ai import ElevenLabsConvAI
 SPEECH_RMS_THRESHOLD = int(os.getenv("ELEVENLABS_SPEECH_THRESHOLD", "300"))
 SILENCE_TIMEOUT = float(os.getenv("ELEVENLABS_SILENCE_TIMEOUT", "0.8"))
 
+# Аудио в ElevenLabs копится и уходит пачками по ~100ms вместо сообщения на каждый кадр
+SEND_BUFFER_INTERVAL = 0.1
+
+# Пока Asterisk молчит дольше этого, шлём ему кадр тишины
+KEEPALIVE_INTERVAL = 0.5
+
+# Темп отправки кадров агента в Asterisk
+SEND_FRAME_INTERVAL = 0.01
+
+# Границы буфера записи в сокет Asterisk (backpressure для drain)
+WRITE_BUFFER_HIGH = 16384
+WRITE_BUFFER_LOW = 4096
+
+# Заголовок кадра AudioSocket: тип, длина payload
+AUDIOSOCKET_HEADER = struct.Struct('!BH')
+FRAME_HEADER_AUDIO = AUDIOSOCKET_HEADER.pack(0x10, 160)  # исходящие кадры всегда по 160 байт
+SILENCE_FRAME = FRAME_HEADER_AUDIO + (b'\x00' * 160)
+
+# Пул заранее подключённых сессий ElevenLabs. Возраст ограничен коротким сроком:
+# разговор на стороне ElevenLabs уже идёт и закрывается по неактивности.
+# Каждая сессия в пуле - начатый разговор и занятый слот тарифа, поэтому пул
+# выключен по умолчанию (0) и включается явно
+ELEVENLABS_POOL_SIZE = int(os.getenv("ELEVENLABS_POOL_SIZE", "0"))
+ELEVENLABS_SESSION_MAX_AGE = float(os.getenv("ELEVENLABS_SESSION_MAX_AGE", "15"))
+# Как часто пул заменяет устаревшие сессии, независимо от входящих звонков
+ELEVENLABS_POOL_REFRESH_INTERVAL = ELEVENLABS_SESSION_MAX_AGE / 3
+
 # Маппинг отделов на SIP URI в Mango Office
 DEPARTMENT_EXTENSIONS = {
     'sales': 'sip:grizzli@formulaopel.mangosip.ru',
@@ -79,6 +130,98 @@ DEPARTMENT_EXTENSIONS = {
 }
 
 
+# Кодирование PCM16 8kHz от Asterisk под входной формат агента ElevenLabs:
+# формат -> (создание кодировщика на звонок, размер пачки на отправку = 100ms в этом формате)
+INPUT_ENCODERS = {
+    'ulaw_8000': (UlawEncoder, 800),
+    'pcm_8000': (lambda: bytes, 1600),
+    'pcm_16000': (StreamingUpsampler, 3200),
+}
+
+
+class ElevenLabsSessionPool:
+    """
+    Пул прогретых сессий ElevenLabs Conversational AI
+    TLS, handshake и приветственные метаданные получены до звонка.
+    Сессия отдаётся одному звонку и после него закрывается,
+    вместо неё в фоне подключается новая. Устаревшие сессии
+    заменяет фоновый таймер, пока сессия ждёт - на её ping отвечает keep_idle
+    """
+    
+    def __init__(self, size: int = ELEVENLABS_POOL_SIZE):
+        self.size = size
+        self.idle = asyncio.Queue()
+        self.refill_tasks = set()
+        self.refresh_task = None
+        
+    def start_refill(self):
+        """Подключить одну сессию в пул в фоне"""
+        task = asyncio.create_task(self.refill())
+        self.refill_tasks.add(task)
+        task.add_done_callback(self.refill_tasks.discard)
+        
+    async def refill(self):
+        """Добавить в пул одну подключённую сессию"""
+        elevenlabs = ElevenLabsConvAI()
+        if await elevenlabs.connect(idle=True):
+            keeper = asyncio.create_task(elevenlabs.keep_idle())
+            await self.idle.put((elevenlabs, time.monotonic(), keeper))
+            
+    async def discard(self, elevenlabs, keeper):
+        """Закрыть сессию из пула"""
+        keeper.cancel()
+        await elevenlabs.close()
+            
+    async def warm_up(self):
+        """Заполнить пул при старте и запустить фоновое обновление"""
+        if self.size <= 0:
+            return
+        await asyncio.gather(*(self.refill() for _ in range(self.size)))
+        print(f"[AUDIOSOCKET] ElevenLabs pool warmed: {self.idle.qsize()}/{self.size}")
+        self.refresh_task = asyncio.create_task(self.refresh())
+        
+    async def refresh(self):
+        """
+        По таймеру закрыть устаревшие и мёртвые сессии и добрать пул до размера
+        Так пул свежий и после долгой паузы между звонками
+        """
+        while True:
+            await asyncio.sleep(ELEVENLABS_POOL_REFRESH_INTERVAL)
+            
+            # Свежие сессии сразу возвращаются в очередь, чтобы acquire их видел
+            stale = []
+            for _ in range(self.idle.qsize()):
+                elevenlabs, created_at, keeper = self.idle.get_nowait()
+                if elevenlabs.ws.open and time.monotonic() - created_at < ELEVENLABS_SESSION_MAX_AGE:
+                    self.idle.put_nowait((elevenlabs, created_at, keeper))
+                else:
+                    stale.append((elevenlabs, keeper))
+            
+            for _ in range(self.size - self.idle.qsize() - len(self.refill_tasks)):
+                self.start_refill()
+            for elevenlabs, keeper in stale:
+                await self.discard(elevenlabs, keeper)
+        
+    async def acquire(self):
+        """
+        Взять прогретую сессию, либо подключиться сразу если пул пуст
+        Возвращает None, если подключиться не удалось
+        """
+        while not self.idle.empty():
+            elevenlabs, created_at, keeper = self.idle.get_nowait()
+            if elevenlabs.ws.open and time.monotonic() - created_at < ELEVENLABS_SESSION_MAX_AGE:
+                keeper.cancel()
+                # recv() должен завершиться до того, как сессию начнёт читать звонок
+                await asyncio.gather(keeper, return_exceptions=True)
+                self.start_refill()
+                return elevenlabs
+            # Устаревшие не заменяем здесь: этим занимается refresh по таймеру
+            await self.discard(elevenlabs, keeper)
+        
+        elevenlabs = ElevenLabsConvAI()
+        return elevenlabs if await elevenlabs.connect() else None
+
+
 class AudioSocketServer:
     """
     AudioSocket сервер для приёма аудио от Asterisk
@@ -88,6 +231,7 @@ class AudioSocketServer:
     def __init__(self, host='0.0.0.0', port=9092):
         self.host = host
         self.port = port
+        self.pool = ElevenLabsSessionPool()
         
     async def handle_connection(self, reader, writer):
         """Обработка подключения от Asterisk"""
@@ -96,10 +240,20 @@ class AudioSocketServer:
         
         print(f"[AUDIOSOCKET] New connection from {addr}, call_id: {call_id}")
         
-        # Создаём ElevenLabs агента
-        elevenlabs = ElevenLabsConvAI()
+        # Кадры по 163 байта каждые 20ms: без Nagle и без отложенных ACK
+        sock = writer.get_extra_info('socket')
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if hasattr(socket, 'TCP_QUICKACK'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+        
+        # Небольшой буфер записи: drain() начинает тормозить отправку раньше,
+        # кадры по 160 байт не копятся в памяти секундами
+        writer.transport.set_write_buffer_limits(high=WRITE_BUFFER_HIGH, low=WRITE_BUFFER_LOW)
+        
+        # Берём подключённого ElevenLabs агента из пула
+        elevenlabs = await self.pool.acquire()
         
-        if not await elevenlabs.connect():
+        if elevenlabs is None:
             print("[AUDIOSOCKET] Failed to connect to ElevenLabs")
             writer.close()
             await writer.wait_closed()
@@ -159,20 +313,65 @@ class AudioSocketServer:
             await writer.wait_closed()
             print(f"[AUDIOSOCKET] Closed: {call_id}", flush=True)
             
+    async def read_frames(self, reader, writer):
+        """
+        Чтение кадров AudioSocket крупными блоками с разбором в памяти
+        Отдаёт (frame_type, payload); пока Asterisk молчит - шлём тишину
+        """
+        buf = bytearray()
+        last_rx = time.monotonic()
+        
+        async def keep_alive():
+            # Один таймер на соединение вместо wait_for на каждое чтение
+            while True:
+                await asyncio.sleep(KEEPALIVE_INTERVAL)
+                if time.monotonic() - last_rx >= KEEPALIVE_INTERVAL:
+                    # Отправляем тишину чтобы держать соединение
+                    writer.write(SILENCE_FRAME)
+                    try:
+                        await writer.drain()
+                    except ConnectionError:
+                        return
+        
+        keepalive_task = asyncio.create_task(keep_alive())
+        try:
+            while True:
+                # Разбираем все полные кадры, накопленные в буфере.
+                # Payload копируется один раз - из memoryview сразу в bytes
+                offset = 0
+                with memoryview(buf) as view:
+                    while len(buf) - offset >= 3:
+                        # Заголовок 3 байта: тип и длина big-endian, без вызова struct
+                        frame_type = buf[offset]
+                        length = (buf[offset + 1] << 8) | buf[offset + 2]
+                        end = offset + 3 + length
+                        if len(buf) < end:
+                            break
+                        yield frame_type, bytes(view[offset + 3:end])
+                        offset = end
+                del buf[:offset]
+                
+                data = await reader.read(8192)
+                if not data:
+                    raise asyncio.IncompleteReadError(bytes(buf), None)
+                last_rx = time.monotonic()
+                buf += data
+        finally:
+            keepalive_task.cancel()
+            
     async def receive_from_asterisk(self, reader, writer, elevenlabs: ElevenLabsConvAI):
         """
         Получение аудио от Asterisk и отправка в ElevenLabs
         """
         print("[AUDIOSOCKET] Started receiving from Asterisk")
         frame_count = 0
+        frames = self.read_frames(reader, writer)
         
         try:
             # Первый фрейм - UUID (тип 0x01)
-            uuid_header = await reader.readexactly(3)
-            uuid_type, uuid_len = struct.unpack('!BH', uuid_header)
+            uuid_type, uuid_bytes = await anext(frames)
             
             if uuid_type == 0x01:  # UUID frame
-                uuid_bytes = await reader.readexactly(uuid_len)
                 # Пробуем декодировать как строку (может быть caller_number)
                 try:
                     caller_number = uuid_bytes.decode('utf-8').strip()
@@ -187,52 +386,47 @@ class AudioSocketServer:
             
             print("[AUDIOSOCKET] Now reading audio frames...")
             
+            # Формат выбираем один раз на звонок, а не на каждом кадре
+            input_format = elevenlabs.user_input_audio_format or 'ulaw_8000'
+            make_encoder, send_buffer_bytes = INPUT_ENCODERS.get(input_format, INPUT_ENCODERS['ulaw_8000'])
+            encode_input = make_encoder()
+            print(f"[AUDIOSOCKET] Sending audio to ElevenLabs as {input_format}")
+            
             speaking = False
             last_voice_ts = time.monotonic()
+            send_buffer = bytearray()
+            last_send_ts = last_voice_ts
 
-            while True:
-                # Читаем аудио фреймы
-                try:
-                    header = await asyncio.wait_for(reader.readexactly(3), timeout=0.5)
-                except asyncio.TimeoutError:
-                    # Отправляем тишину чтобы держать соединение
-                    silence = struct.pack('!BH', 0x10, 160) + (b'\x00' * 160)
-                    writer.write(silence)
-                    await writer.drain()
-                    continue
-                    
-                if not header or len(header) < 3:
-                    break
-                    
-                frame_type, length = struct.unpack('!BH', header)
-                
+            # Читаем аудио фреймы
+            async for frame_type, audio_data in frames:
                 if frame_type == 0x10:  # Audio frame (0x10 = 16)
-                    # Читаем аудио данные
-                    audio_data = await reader.readexactly(length)
                     frame_count += 1
                     
                     if frame_count <= 5 or frame_count % 50 == 0:
-                        print(f"[AUDIOSOCKET] Frame #{frame_count}: type={frame_type:02x}, len={length}, data={len(audio_data)} bytes")
+                        print(f"[AUDIOSOCKET] Frame #{frame_count}: type={frame_type:02x}, len={len(audio_data)} bytes")
                     
                     # Читаем энергетику, чтобы убедиться что аудио не пустое
                     try:
-                        rms = audioop.rms(audio_data, 2)
+                        rms = frame_rms(audio_data)
                     except Exception:
                         rms = 0
 
-                    # Конвертируем PCM16 8kHz → μ-law 8kHz
+                    # Конвертируем PCM16 8kHz → формат агента (по умолчанию μ-law 8kHz)
+                    now = time.monotonic()
                     try:
-                        ulaw_payload = audioop.lin2ulaw(audio_data, 2)
-                        await elevenlabs.send_audio(ulaw_payload)
-                        if frame_count <= 5 or frame_count % 50 == 0:
-                            print(
-                                f"[ELEVEN] Sent audio chunk #{frame_count}: "
-                                f"{len(ulaw_payload)} bytes (PCM16→μ-law, rms={rms})"
-                            )
+                        send_buffer += encode_input(audio_data)
+                        if len(send_buffer) >= send_buffer_bytes or now - last_send_ts >= SEND_BUFFER_INTERVAL:
+                            await elevenlabs.send_audio(bytes(send_buffer))
+                            if frame_count <= 5 or frame_count % 50 == 0:
+                                print(
+                                    f"[ELEVEN] Sent audio up to frame #{frame_count}: "
+                                    f"{len(send_buffer)} bytes ({input_format}, rms={rms})"
+                                )
+                            send_buffer.clear()
+                            last_send_ts = now
                     except Exception as e:
                         print(f"[ELEVEN] Error converting/sending audio: {e}")
 
-                    now = time.monotonic()
                     if rms >= SPEECH_RMS_THRESHOLD:
                         if not speaking:
                             speaking = True
@@ -242,6 +436,11 @@ class AudioSocketServer:
                         if speaking and (now - last_voice_ts) >= SILENCE_TIMEOUT:
                             speaking = False
                             try:
+                                # Хвост реплики должен уйти раньше сигнала о конце хода
+                                if send_buffer:
+                                    await elevenlabs.send_audio(bytes(send_buffer))
+                                    send_buffer.clear()
+                                    last_send_ts = now
                                 await elevenlabs.end_user_turn()
                                 print(
                                     f"[ELEVEN] Sent user_activity after {frame_count} frames "
@@ -252,6 +451,9 @@ class AudioSocketServer:
                     
                 elif frame_type == 0x00:  # Hangup
                     print(f"[AUDIOSOCKET] Hangup signal received after {frame_count} frames")
+                    if send_buffer:
+                        await elevenlabs.send_audio(bytes(send_buffer))
+                        send_buffer.clear()
                     # Сигнализируем ElevenLabs что пользователь закончил
                     await elevenlabs.end_user_turn()
                     print("[AUDIOSOCKET] Sent user_audio_done to ElevenLabs")
@@ -269,6 +471,9 @@ class AudioSocketServer:
             print(f"[AUDIOSOCKET] Connection closed by Asterisk (received {frame_count} frames)")
         except Exception as e:
             print(f"[AUDIOSOCKET] Receive error: {e} (received {frame_count} frames)")
+        finally:
+            # Закрываем генератор сразу - вместе с ним останавливается keep-alive
+            await frames.aclose()
             
     async def send_to_asterisk(self, writer, elevenlabs: ElevenLabsConvAI):
         """
@@ -279,12 +484,16 @@ class AudioSocketServer:
         total_sent = 0
         chunks_sent = 0
         chunk_size = 160  # 20ms μ-law @8kHz
+        deadline = time.monotonic()
         
         try:
             while True:
                 # Читаем следующий чанк из очереди
                 audio_chunk = await elevenlabs.audio_queue.get()
                 
+                # После паузы в ответе начинаем отсчёт кадров заново, а не догоняем
+                deadline = max(deadline, time.monotonic())
+                
                 # None = конец ответа агента
                 if audio_chunk is None:
                     print(f"[AUDIOSOCKET] ✅ Agent response sent: {total_sent} bytes in {chunks_sent} frames")
@@ -292,25 +501,30 @@ class AudioSocketServer:
                     chunks_sent = 0
                     continue
                 
-                # Разбиваем большой чанк на мелкие кадры
+                # Разбиваем большой чанк на мелкие кадры (memoryview - без копий срезов)
+                chunk_view = memoryview(audio_chunk)
                 for offset in range(0, len(audio_chunk), chunk_size):
-                    frame_data = audio_chunk[offset:offset+chunk_size]
+                    frame_data = chunk_view[offset:offset+chunk_size]
                     if len(frame_data) < chunk_size:
-                        frame_data = frame_data.ljust(chunk_size, b'\xff')
+                        frame_data = bytes(frame_data).ljust(chunk_size, b'\xff')
                     
-                    # AudioSocket audio frame: 0x10 + length + data
-                    frame = struct.pack('!BH', 0x10, len(frame_data)) + frame_data
-                    writer.write(frame)
-                    await writer.drain()
+                    # AudioSocket audio frame: 0x10 + length + data, без склейки в новый bytes
+                    writer.writelines((FRAME_HEADER_AUDIO, frame_data))
                     
                     total_sent += len(frame_data)
                     chunks_sent += 1
                     
                     # Задержка 10ms для качественного звука (НЕ УДАЛЯТЬ!)
-                    await asyncio.sleep(0.01)
+                    # Считаем от дедлайна, чтобы накладные расходы не растягивали темп
+                    deadline += SEND_FRAME_INTERVAL
+                    await asyncio.sleep(max(deadline - time.monotonic(), 0))
                     
                     if chunks_sent <= 5 or chunks_sent % 50 == 0:
                         print(f"[AUDIOSOCKET] ⬅️ Sent frame #{chunks_sent}: {len(frame_data)} bytes")
+                
+                # Кадры чанка уже разнесены паузами, буфер сокета не копится -
+                # backpressure достаточно проверить раз на чанк
+                await writer.drain()
             
         except Exception as e:
             print(f"[AUDIOSOCKET] Send error: {e}")
@@ -321,6 +535,8 @@ class AudioSocketServer:
         """Запуск сервера"""
         print(f"[AUDIOSOCKET] Starting server on {self.host}:{self.port}...")
         
+        await self.pool.warm_up()
+        
         server = await asyncio.start_server(
             self.handle_connection,
             self.host,
@@ -342,6 +558,7 @@ async def main():
 
 
 if __name__ == '__main__':
+    uvloop.install()
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
@@ -4,25 +4,16 @@ ElevenLabs Conversational AI integration
 Real-time voice agent через WebSocket
 """
 import asyncio
-import json
+import collections
+import orjson
 import os
-import base64
-from pathlib import Path
+import re
+import pybase64
 import websockets
 import httpx
+from env import load_env
 
-# Manual .env loading
-try:
-    env_path = Path(__file__).parent.parent / '.env'
-    with open(env_path, 'r') as f:
-        for line in f:
-            line = line.strip()
-            if line and not line.startswith('#') and '=' in line:
-                key, value = line.split('=', 1)
-                os.environ[key] = value
-    print("[INIT] Loaded .env for ElevenLabs Conv AI")
-except Exception as e:
-    print(f"[WARN] .env loading: {e}")
+load_env()
 
 ELEVENLABS_API_KEY = os.getenv('ELEVENLABS_API_KEY')
 ELEVENLABS_AGENT_ID = os.getenv('ELEVENLABS_AGENT_ID', 'your-agent-id')
@@ -30,6 +21,33 @@ ELEVENLABS_AGENT_ID = os.getenv('ELEVENLABS_AGENT_ID', 'your-agent-id')
 # ElevenLabs Conversational AI WebSocket endpoint
 ELEVENLABS_WS_URL = "wss://api.elevenlabs.io/v1/convai/conversation"
 
+# Очередь аудио агента ограничена: если Asterisk перестал забирать кадры,
+# старые чанки отбрасываются, а не копятся в памяти без предела
+AUDIO_QUEUE_SIZE = int(os.getenv('ELEVENLABS_AUDIO_QUEUE_SIZE', '200'))
+
+# Keepalive живого звонка: pong может задержаться под нагрузкой или за пачкой
+# аудио, короткий таймаут оборвал бы разговор
+PING_INTERVAL = float(os.getenv('ELEVENLABS_PING_INTERVAL', '20'))
+PING_TIMEOUT = float(os.getenv('ELEVENLABS_PING_TIMEOUT', '10'))
+# Сессия в пуле живёт до ELEVENLABS_SESSION_MAX_AGE (15s) и без трафика:
+# пинг чаще этого срока выявляет мёртвое соединение до того, как пул выдаст его звонку
+IDLE_PING_INTERVAL = 5
+IDLE_PING_TIMEOUT = 5
+
+# vad_score приходит много раз в секунду и почти всегда ниже порога логирования:
+# такие короткие сообщения разбираем регулярками, без полного JSON
+SMALL_EVENT_MAX_LEN = 256
+VAD_EVENT_RE = re.compile(r'"type"\s*:\s*"vad_score"')
+VAD_SCORE_RE = re.compile(r'"vad_score"\s*:\s*(-?[0-9.]+(?:[eE][-+]?[0-9]+)?)')
+VAD_LOG_THRESHOLD = 0.3
+
+# Сообщение с аудио пользователя: {"user_audio_chunk": "<base64>"}
+USER_AUDIO_CHUNK_TEMPLATE = '{"user_audio_chunk":"%s"}'
+
+# Постоянные служебные сообщения сериализуются один раз
+USER_ACTIVITY_MESSAGE = orjson.dumps({"type": "user_activity"}).decode()
+PONG_TEMPLATE = '{"type":"pong","event_id":%s}'
+
 print(f"[INIT] ElevenLabs API key: {ELEVENLABS_API_KEY[:20] if ELEVENLABS_API_KEY else 'NOT SET'}...")
 print(f"[INIT] Agent ID: {ELEVENLABS_AGENT_ID}")
 
@@ -48,11 +66,17 @@ class ElevenLabsConvAI:
         self.transfer_queue = None
         self.transfer_department = None
         self.caller_number = None  # Номер звонящего из Asterisk
+        self.user_input_audio_format = None  # Формат аудио, который ждёт агент
+        self.agent_output_audio_format = None  # Формат аудио, который отдаёт агент
+        self.backlog = collections.deque()  # События, прочитанные пока сессия ждала звонка
         
-    async def connect(self):
-        """Подключение к ElevenLabs Conversational AI"""
+    async def connect(self, idle: bool = False):
+        """
+        Подключение к ElevenLabs Conversational AI
+        idle=True - сессия для пула: частый keepalive до выдачи звонку (см. keep_idle)
+        """
         try:
-            self.audio_queue = asyncio.Queue()
+            self.audio_queue = asyncio.Queue(maxsize=AUDIO_QUEUE_SIZE)
             self.transfer_queue = asyncio.Queue()
             
             # Формируем URL с API ключом
@@ -64,22 +88,33 @@ class ElevenLabsConvAI:
             
             print(f"[ELEVEN] Connecting to Conversational AI...")
             
-            self.ws = await websockets.connect(url, extra_headers=headers)
+            # compression=None: deflate на base64 аудио только тратит CPU
+            self.ws = await websockets.connect(
+                url,
+                extra_headers=headers,
+                compression=None,
+                max_size=2**20,
+                write_limit=2**20,
+                ping_interval=IDLE_PING_INTERVAL if idle else PING_INTERVAL,
+                ping_timeout=IDLE_PING_TIMEOUT if idle else PING_TIMEOUT
+            )
             
             print("[ELEVEN] ✅ Connected to ElevenLabs Conversational AI")
             
             # Получаем приветственное сообщение
             welcome = await self.ws.recv()
-            welcome_data = json.loads(welcome)
+            welcome_data = orjson.loads(welcome)
             
             print(f"[ELEVEN] Welcome message: {welcome[:100]}...")
             
             if welcome_data.get('type') == 'conversation_initiation_metadata':
                 metadata = welcome_data.get('conversation_initiation_metadata_event', {})
                 self.conversation_id = metadata.get('conversation_id')
-                audio_format = metadata.get('user_input_audio_format')
+                self.user_input_audio_format = metadata.get('user_input_audio_format')
+                self.agent_output_audio_format = metadata.get('agent_output_audio_format')
                 print(f"[ELEVEN] Conversation ID: {self.conversation_id}")
-                print(f"[ELEVEN] Audio format: {audio_format}")
+                print(f"[ELEVEN] Audio format: {self.user_input_audio_format} in, "
+                      f"{self.agent_output_audio_format} out")
             
             return True
             
@@ -95,25 +130,81 @@ class ElevenLabsConvAI:
         if not self.ws:
             await self.connect()
         
-        # Кодируем в base64
-        audio_base64 = base64.b64encode(audio_chunk).decode('utf-8')
+        # Кодируем в base64 (SIMD pybase64, сразу str)
+        audio_base64 = pybase64.b64encode_as_string(audio_chunk)
         
         # Правильный формат по документации:
         # https://elevenlabs.io/docs/agents-platform/api-reference/agents-platform/websocket
-        message = {
-            "user_audio_chunk": audio_base64
-        }
-        
-        await self.ws.send(json.dumps(message))
+        # Схема фиксированная, а в base64 нет кавычек и экранируемых символов -
+        # собираем JSON по шаблону без сериализатора
+        await self.ws.send(USER_AUDIO_CHUNK_TEMPLATE % audio_base64)
         
     async def end_user_turn(self):
         """Сигнализируем что пользователь закончил говорить"""
         # По документации: user_activity для сигнала активности
-        message = {
-            "type": "user_activity"
-        }
-        await self.ws.send(json.dumps(message))
+        await self.ws.send(USER_ACTIVITY_MESSAGE)
+        
+    def queue_audio(self, item):
+        """
+        Положить чанк аудио (или None - конец ответа) в очередь без ожидания
+        При переполнении выбрасываем самый старый чанк: лучше потерять
+        устаревший звук, чем бесконечно наращивать задержку и память.
+        Маркеры None не выбрасываются - по ним потребители сбрасывают
+        состояние ответа и выходят из ожидания
+        """
+        try:
+            self.audio_queue.put_nowait(item)
+        except asyncio.QueueFull:
+            # Переполнение редкое - пересобираем очередь без самого старого аудио
+            items = [self.audio_queue.get_nowait() for _ in range(self.audio_queue.qsize())]
+            oldest = next((i for i, queued in enumerate(items) if queued is not None), None)
+            if oldest is not None:
+                del items[oldest]
+            for queued in items:
+                self.audio_queue.put_nowait(queued)
+            if oldest is None:
+                # В очереди одни маркеры - места нет, отбрасываем новый элемент
+                print("[ELEVEN] Audio queue full of end markers, dropped new item")
+                return
+            self.audio_queue.put_nowait(item)
+            print("[ELEVEN] Audio queue full, dropped oldest chunk")
+            
+    async def drain_audio(self) -> list:
+        """
+        Дождаться аудио агента и забрать всё, что уже накопилось в очереди
+        Пачка заканчивается на None (конец ответа), если он встретился
+        """
+        batch = [await self.audio_queue.get()]
+        while batch[-1] is not None and not self.audio_queue.empty():
+            batch.append(self.audio_queue.get_nowait())
+        return batch
         
+    async def keep_idle(self):
+        """
+        Держать сессию, пока она ждёт звонка в пуле
+        На ping отвечаем сразу, остальные события (приветствие агента)
+        откладываются в backlog и обрабатываются в stream_responses
+        Отмена безопасна: websockets не теряет сообщение при отмене recv()
+        Сессия должна быть подключена с connect(idle=True)
+        """
+        try:
+            while True:
+                message = await self.ws.recv()
+                data = orjson.loads(message)
+                if data.get('type') == 'ping':
+                    event_id = data.get('ping_event', {}).get('event_id')
+                    if event_id:
+                        await self.ws.send(PONG_TEMPLATE % orjson.dumps(event_id).decode())
+                else:
+                    self.backlog.append(message)
+        except websockets.ConnectionClosed as exc:
+            print(f"[ELEVEN] Idle session closed: {exc}")
+        finally:
+            # Сессию забрал звонок - дальше keepalive живого звонка
+            # (websockets читает эти значения на каждом цикле пинга)
+            self.ws.ping_interval = PING_INTERVAL
+            self.ws.ping_timeout = PING_TIMEOUT
+            
     async def stream_responses(self):
         """
         Постоянный стрим событий от ElevenLabs
@@ -127,8 +218,16 @@ class ElevenLabsConvAI:
 
         try:
             while True:
-                message = await self.ws.recv()
-                data = json.loads(message)
+                message = self.backlog.popleft() if self.backlog else await self.ws.recv()
+                
+                if len(message) <= SMALL_EVENT_MAX_LEN and VAD_EVENT_RE.search(message):
+                    score = VAD_SCORE_RE.search(message)
+                    vad_value = float(score.group(1)) if score else 0
+                    if vad_value > VAD_LOG_THRESHOLD:
+                        print(f"[ELEVEN] 🎤 VAD: {vad_value:.2f}")
+                    continue
+                
+                data = orjson.loads(message)
 
                 msg_type = data.get('type')
 
@@ -136,10 +235,11 @@ class ElevenLabsConvAI:
                     audio_event = data.get('audio_event', {})
                     audio_base64 = audio_event.get('audio_base_64', '')
                     if audio_base64:
-                        audio_data = base64.b64decode(audio_base64)
+                        audio_data = pybase64.b64decode(audio_base64)
                         chunk_count += 1
-                        await self.audio_queue.put(audio_data)
-                        print(f"[ELEVEN] 🔊 Agent audio chunk #{chunk_count}: {len(audio_data)} bytes → queued")
+                        self.queue_audio(audio_data)
+                        if chunk_count <= 5 or chunk_count % 50 == 0:
+                            print(f"[ELEVEN] 🔊 Agent audio chunk #{chunk_count}: {len(audio_data)} bytes → queued")
 
                 elif msg_type == 'agent_response':
                     agent_response_event = data.get('agent_response_event', {})
@@ -149,7 +249,7 @@ class ElevenLabsConvAI:
 
                 elif msg_type == 'agent_response_end':
                     print(f"[ELEVEN] Agent response complete: {chunk_count} audio chunks")
-                    await self.audio_queue.put(None)
+                    self.queue_audio(None)
                     chunk_count = 0
 
                 elif msg_type == 'user_transcript':
@@ -161,14 +261,14 @@ class ElevenLabsConvAI:
                 elif msg_type == 'vad_score':
                     vad_event = data.get('vad_score_event', {})
                     vad_value = vad_event.get('vad_score', 0)
-                    if vad_value > 0.3:
+                    if vad_value > VAD_LOG_THRESHOLD:
                         print(f"[ELEVEN] 🎤 VAD: {vad_value:.2f}")
 
                 elif msg_type == 'ping':
                     ping_event = data.get('ping_event', {})
                     event_id = ping_event.get('event_id')
                     if event_id:
-                        await self.ws.send(json.dumps({"type": "pong", "event_id": event_id}))
+                        await self.ws.send(PONG_TEMPLATE % orjson.dumps(event_id).decode())
 
                 elif msg_type == 'client_tool_call':
                     # Клиентский инструмент вызван агентом
@@ -206,21 +306,21 @@ class ElevenLabsConvAI:
                             "result": f"Transferring to {department} department",
                             "is_error": False
                         }
-                        await self.ws.send(json.dumps(result_msg))
+                        await self.ws.send(orjson.dumps(result_msg).decode())
                         print(f"[ELEVEN] ✅ Sent tool result for {tool_call_id}")
 
                 elif msg_type == 'error':
                     print(f"[ELEVEN] Error: {data}")
-                    await self.audio_queue.put(None)
+                    self.queue_audio(None)
                     break
                 
                 else:
                     # Логируем неизвестные события (включая agent_tool_response)
-                    print(f"[ELEVEN] Unknown event: {msg_type} -> {json.dumps(data, ensure_ascii=False)[:200]}")
+                    print(f"[ELEVEN] Unknown event: {msg_type} -> {orjson.dumps(data).decode()[:200]}")
 
         except websockets.ConnectionClosed as exc:
             print(f"[ELEVEN] Connection closed: {exc}")
-            await self.audio_queue.put(None)
+            self.queue_audio(None)
         
     async def close(self):
         """Закрытие соединения"""
@@ -237,20 +337,31 @@ async def test_elevenlabs_conv_ai():
         print("[TEST] Failed to connect")
         return
     
-    # Симуляция отправки аудио
-    print("[TEST] Sending test audio...")
-    dummy_audio = b'\x00\x00' * 8000  # 1 секунда тишины
-    await agent.send_audio(dummy_audio)
-    await agent.end_user_turn()
-    
-    # Получаем ответ
-    print("[TEST] Waiting for response...")
-    text, audio = await agent.receive_response()
-    
-    print(f"[TEST] Response text: {text}")
-    print(f"[TEST] Response audio chunks: {len(audio)}")
-    
-    await agent.close()
+    try:
+        # События читаются параллельно с отправкой аудио - как в серверах
+        async with asyncio.TaskGroup() as tg:
+            reader = tg.create_task(agent.stream_responses())
+            
+            # Симуляция отправки аудио
+            print("[TEST] Sending test audio...")
+            dummy_audio = b'\x00\x00' * 8000  # 1 секунда тишины
+            await agent.send_audio(dummy_audio)
+            await agent.end_user_turn()
+            
+            # Получаем ответ (текст печатает stream_responses)
+            print("[TEST] Waiting for response...")
+            audio_chunks = 0
+            while True:
+                batch = await agent.drain_audio()
+                if batch[-1] is None:
+                    audio_chunks += len(batch) - 1
+                    break
+                audio_chunks += len(batch)
+            
+            print(f"[TEST] Response audio chunks: {audio_chunks}")
+            reader.cancel()
+    finally:
+        await agent.close()
 
 
 if __name__ == '__main__':
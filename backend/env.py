@@ -0,0 +1,22 @@
+"""
+Загрузка .env один раз на процесс
+"""
+import functools
+from pathlib import Path
+from dotenv import load_dotenv
+
+ENV_PATH = Path(__file__).parent.parent / '.env'
+
+
+@functools.cache
+def load_env() -> bool:
+    """
+    Загрузить .env в os.environ
+    Повторные вызовы (из других модулей) файл уже не читают
+    """
+    loaded = load_dotenv(ENV_PATH, override=True)
+    if loaded:
+        print(f"[INIT] Loaded .env from {ENV_PATH}")
+    else:
+        print(f"[WARN] .env not found: {ENV_PATH}")
+    return loaded
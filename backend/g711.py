@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""
+G.711 µ-law кодек на таблицах NumPy
+Таблицы строятся один раз при импорте, кодирование кадра - одна выборка по индексу.
+Результат совпадает с audioop.lin2ulaw / audioop.ulaw2lin
+"""
+import numpy as np
+
+ULAW_BIAS = 0x84
+ULAW_CLIP = 8159
+ULAW_SEGMENT_END = (0x3F, 0x7F, 0xFF, 0x1FF, 0x3FF, 0x7FF, 0xFFF, 0x1FFF)
+
+
+def _linear_to_ulaw(sample: int) -> int:
+    """Один сэмпл int16 → байт µ-law (алгоритм g711.c)"""
+    sample >>= 2
+    if sample < 0:
+        sample = -sample
+        mask = 0x7F
+    else:
+        mask = 0xFF
+    sample = min(sample, ULAW_CLIP) + (ULAW_BIAS >> 2)
+    for segment, end in enumerate(ULAW_SEGMENT_END):
+        if sample <= end:
+            return ((segment << 4) | ((sample >> (segment + 1)) & 0x0F)) ^ mask
+    return 0x7F ^ mask
+
+
+def _ulaw_to_linear(value: int) -> int:
+    """Один байт µ-law → сэмпл int16"""
+    value = ~value & 0xFF
+    sample = (((value & 0x0F) << 3) + ULAW_BIAS) << ((value & 0x70) >> 4)
+    return ULAW_BIAS - sample if value & 0x80 else sample - ULAW_BIAS
+
+
+# Индекс - сэмпл int16, прочитанный как uint16
+PCM16_TO_ULAW = np.array(
+    [_linear_to_ulaw(i - 0x10000 if i & 0x8000 else i) for i in range(0x10000)],
+    dtype=np.uint8
+)
+ULAW_TO_PCM16 = np.array([_ulaw_to_linear(i) for i in range(0x100)], dtype='<i2')
+
+
+def pcm16_to_ulaw(pcm: bytes) -> bytes:
+    """PCM16 little-endian → µ-law"""
+    return PCM16_TO_ULAW.take(np.frombuffer(pcm, dtype='<u2')).tobytes()
+
+
+def ulaw_to_pcm16(ulaw: bytes) -> bytes:
+    """µ-law → PCM16 little-endian"""
+    return ULAW_TO_PCM16.take(np.frombuffer(ulaw, dtype=np.uint8)).tobytes()
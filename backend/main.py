@@ -8,13 +8,21 @@ import os
 import hashlib
 import json
 import httpx
+from cachetools import TTLCache
 
 app = FastAPI(title="AI Call Center API")
 
+# Записи живут не дольше CALL_TTL: если webhook call.disconnected потерялся,
+# звонок всё равно вычистится и не будет копиться в памяти.
+# TTL считается от последней записи, каждый webhook звонка продлевает её -
+# срок заведомо больше самого длинного звонка и не вытесняет живые звонки
+CALL_TTL = int(os.getenv('CALL_TTL', '21600'))
+MAX_ACTIVE_CALLS = 10_000
+
 # Хранилище активных звонков: {caller_number: call_id}
-active_calls = {}
+active_calls = TTLCache(maxsize=MAX_ACTIVE_CALLS, ttl=CALL_TTL)
 # Маппинг conversation_id → caller_number
-conversation_to_caller = {}
+conversation_to_caller = TTLCache(maxsize=MAX_ACTIVE_CALLS, ttl=CALL_TTL)
 
 # CORS
 app.add_middleware(
@@ -88,6 +96,13 @@ async def mango_webhook(request: Request):
             if from_number in active_calls:
                 del active_calls[from_number]
         
+        else:
+            # Любое другое событие звонка - он ещё идёт, продлеваем запись
+            from_number = data.get('from', {}).get('number', '')
+            call_id = active_calls.get(from_number)
+            if call_id:
+                active_calls[from_number] = call_id
+        
         return {"status": "ok"}
     except Exception as e:
         print(f"[MANGO] Webhook error: {e}", flush=True)
@@ -171,5 +186,5 @@ async def transfer_call(key: str, department: str):
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    uvicorn.run(app, host="0.0.0.0", port=8000, loop="uvloop", http="httptools")
 
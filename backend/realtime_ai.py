@@ -4,25 +4,14 @@ Real-time AI обработка звонков через OpenAI Realtime API
 WebSocket streaming для мгновенной обработки речи
 """
 import asyncio
-import json
 import os
 import base64
-from pathlib import Path
 import websockets
+import orjson
 from fastapi import WebSocket as FastAPIWebSocket
+from env import load_env
 
-# Manual .env loading
-try:
-    env_path = Path(__file__).parent.parent / '.env'
-    with open(env_path, 'r') as f:
-        for line in f:
-            line = line.strip()
-            if line and not line.startswith('#') and '=' in line:
-                key, value = line.split('=', 1)
-                os.environ[key] = value
-    print("[INIT] Loaded .env for realtime")
-except Exception as e:
-    print(f"[WARN] Could not load .env: {e}")
+load_env()
 
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 OPENAI_REALTIME_URL = "wss://api.openai.com/v1/realtime?model=gpt-4o-realtime-preview-2024-10-01"
@@ -67,7 +56,7 @@ class RealtimeAIHandler:
             }
         }
         
-        await self.openai_ws.send(json.dumps(config))
+        await self.openai_ws.send(orjson.dumps(config).decode())
         print("[REALTIME] Connected to OpenAI")
         
     async def send_audio_chunk(self, audio_data: bytes):
@@ -86,14 +75,14 @@ class RealtimeAIHandler:
             "audio": audio_base64
         }
         
-        await self.openai_ws.send(json.dumps(event))
+        await self.openai_ws.send(orjson.dumps(event).decode())
         
     async def commit_audio(self):
         """Завершение отправки аудио и запрос ответа"""
         event = {
             "type": "input_audio_buffer.commit"
         }
-        await self.openai_ws.send(json.dumps(event))
+        await self.openai_ws.send(orjson.dumps(event).decode())
         
         # Создаём ответ
         response_event = {
@@ -102,7 +91,7 @@ class RealtimeAIHandler:
                 "modalities": ["text", "audio"]
             }
         }
-        await self.openai_ws.send(json.dumps(response_event))
+        await self.openai_ws.send(orjson.dumps(response_event).decode())
         
     async def receive_response(self):
         """
@@ -115,7 +104,7 @@ class RealtimeAIHandler:
         while True:
             try:
                 message = await asyncio.wait_for(self.openai_ws.recv(), timeout=10.0)
-                event = json.loads(message)
+                event = orjson.loads(message)
                 
                 event_type = event.get("type")
                 
@@ -7,7 +7,7 @@ if [ -f "/opt/ai-call-center/.env" ]; then
 fi
 
 # Запускаем uvicorn в фоне
-uvicorn main:app --host 0.0.0.0 --port 8000 &
+uvicorn main:app --host 0.0.0.0 --port 8000 --loop uvloop --http httptools &
 
 # Проверяем режим AI
 AI_MODE=${AI_MODE:-fastagi}
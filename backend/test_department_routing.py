@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+"""
+Тест быстрого определения отдела по ключевым словам (без GPT)
+Запуск: cd backend && python -m pytest test_department_routing.py
+"""
+import pytest
+
+from agi_handler import match_department
+
+
+@pytest.mark.parametrize("text, department", [
+    # "насчёт" содержит "счёт", но это не про оплату
+    ("Я звоню насчёт подключения интернета", "sales"),
+    ("Хочу подключить интернет", "sales"),
+    ("Сколько стоит ваш тариф?", "sales"),
+    ("У меня не работает интернет", "support"),
+    ("Хочу оплатить счёт", "billing"),
+    ("Мне списали деньги дважды", "billing"),
+])
+def test_match_department(text, department):
+    assert match_department(text) == department
+
+
+@pytest.mark.parametrize("text", [
+    "Я звоню насчёт вашего письма",
+    "Расскажите подробнее",
+    # Несколько отделов сразу - решает GPT
+    "Хочу подключить тариф, но не работает оплата",
+])
+def test_match_department_falls_back_to_gpt(text):
+    assert match_department(text) is None